@@ -1,6 +1,20 @@
 import numpy as np
 
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple, Iterable, Iterator, Optional, Union, IO
+
+import asyncio
+
+from bisect import bisect_left, bisect_right
+
+from array import array
+
+from collections import Counter, OrderedDict, deque
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import itertools
+
+from contextlib import contextmanager
 
 from dataclasses import dataclass
 
@@ -14,10 +28,42 @@ from sentence_transformers import SentenceTransformer
 
 import faiss
 
+import functools
+
+import hashlib
+
+import heapq
+
 import json
 
+import logging
+
+import mmap
+
+import multiprocessing
+
 import os
 
+import queue
+
+import re
+
+import shutil
+
+import sqlite3
+
+import threading
+
+import time
+
+import uuid
+
+import zlib
+
+
+
+logger = logging.getLogger(__name__)
+
 
 
 @dataclass
@@ -30,287 +76,4973 @@ class Document:
 
 
 
-class HybridChunker:
+class ChunkStore:
 
-    def __init__(self, language="en_core_web_sm"):
+    """Columnar chunk records for large document stores.
 
-        self.nlp = spacy.load(language)
+    
 
-        
+    Each source text is kept once and every chunk is three array entries
 
-    def _get_semantic_boundaries(self, text: str) -> List[int]:
+    (source id, start, end) instead of a Document with its own text copy and
 
-        """Find semantic boundaries using SpaCy's parser"""
+    metadata dict. Documents are materialized only when indexed or iterated.
 
-        doc = self.nlp(text)
+    """
 
-        boundaries = [0]
+    def __init__(self):
+
+        self.sources: List[str] = []
+
+        self.source_metadata: List[Dict[str, Any]] = []
+
+        self.source_ids = array("I")
+
+        self.starts = array("Q")
+
+        self.ends = array("Q")
 
         
 
-        for sent in doc.sents:
+    def add_source(self, text: str, chunks: List[Document],
 
-            # Check for semantic completeness using dependency parsing
+                   metadata: Optional[Dict[str, Any]] = None):
 
-            if sent.root.dep_ in ["ROOT"]:
+        """Record the chunks HybridChunker produced for text; metadata is
 
-                boundaries.append(sent.end_char)
+        shared by all of them"""
 
-                
+        source_id = len(self.sources)
 
-        return boundaries
+        self.sources.append(text)
 
-    
+        self.source_metadata.append(metadata or {})
 
-    def chunk_text(self, text: str, max_chunk_size: int = 512, 
+        for chunk in chunks:
 
-                   overlap: int = 50) -> List[Document]:
+            self.source_ids.append(source_id)
 
-        """Create chunks using both fixed-size and semantic boundaries"""
+            self.starts.append(chunk.metadata["start"])
 
-        semantic_boundaries = self._get_semantic_boundaries(text)
+            self.ends.append(chunk.metadata["end"])
 
-        chunks = []
+            
 
-        current_pos = 0
+    def select(self, rows: Iterable[int]) -> "ChunkStore":
 
-        
+        """A new store holding only the given rows, without unused sources"""
 
-        while current_pos < len(text):
+        store = ChunkStore()
 
-            # Find the closest semantic boundary within max_chunk_size
+        remap = {}
 
-            chunk_end = current_pos + max_chunk_size
+        for row in rows:
 
-            best_boundary = chunk_end
+            source_id = self.source_ids[row]
+
+            if source_id not in remap:
+
+                remap[source_id] = len(store.sources)
+
+                store.sources.append(self.sources[source_id])
+
+                store.source_metadata.append(self.source_metadata[source_id])
+
+            store.source_ids.append(remap[source_id])
+
+            store.starts.append(self.starts[row])
+
+            store.ends.append(self.ends[row])
+
+        return store
 
             
 
-            for boundary in semantic_boundaries:
+    def __len__(self) -> int:
 
-                if current_pos < boundary <= chunk_end:
+        return len(self.starts)
 
-                    best_boundary = boundary
+    
 
-                    
+    def __getitem__(self, idx: int) -> Document:
 
-            # Create chunk
+        start, end = self.starts[idx], self.ends[idx]
 
-            chunk_text = text[current_pos:best_boundary].strip()
+        source_id = self.source_ids[idx]
 
-            if chunk_text:
+        text = self.sources[source_id]
 
-                chunks.append(Document(
+        return Document(text=text[start:end].strip(),
 
-                    text=chunk_text,
+                        metadata={**self.source_metadata[source_id], "start": start, "end": end})
 
-                    metadata={"start": current_pos, "end": best_boundary}
+    
 
-                ))
+    def __iter__(self) -> Iterator[Document]:
+
+        for idx in range(len(self)):
+
+            yield self[idx]
 
             
 
-            # Move position considering overlap
+    def save(self, filepath: str, sources_path: str):
+
+        """Chunk arrays to filepath (npz); sources streamed to sources_path as JSONL"""
+
+        with atomic_write(sources_path) as f:
+
+            for text, metadata in zip(self.sources, self.source_metadata):
+
+                f.write(json.dumps({"text": text, "metadata": metadata}).encode("utf-8") + b"\n")
+
+        with atomic_write(filepath) as f:
+
+            np.savez(f,
 
-            current_pos = best_boundary - overlap
+                     source_ids=np.frombuffer(self.source_ids, dtype=np.uint32),
+
+                     starts=np.frombuffer(self.starts, dtype=np.uint64),
+
+                     ends=np.frombuffer(self.ends, dtype=np.uint64))
 
             
 
-        return chunks
+    def load(self, filepath: str, sources_path: str):
 
+        with np.load(filepath) as data:
 
+            self.source_ids = array("I", data["source_ids"].tobytes())
 
-class HybridEncoder:
+            self.starts = array("Q", data["starts"].tobytes())
 
-    def __init__(self, model_name: str = "sentence-transformers/all-mpnet-base-v2"):
+            self.ends = array("Q", data["ends"].tobytes())
 
-        self.model = SentenceTransformer(model_name)
+        self.sources, self.source_metadata = [], []
 
-        
+        with open(sources_path, "rb") as f:
 
-    def encode_documents(self, documents: List[Document]) -> np.ndarray:
+            for line in f:
 
-        """Encode documents using the SentenceTransformer model"""
+                record = json.loads(line)
 
-        texts = [doc.text for doc in documents]
+                self.sources.append(record["text"])
 
-        embeddings = self.model.encode(texts, convert_to_tensor=True)
+                self.source_metadata.append(record["metadata"])
 
-        return embeddings.cpu().numpy()
 
 
+@contextmanager
 
-class FAISSIndex:
+def atomic_write(path: str, mode: str = "wb"):
+
+    """Write path through a temporary file that replaces it only once complete,
+
+    so a crash mid-write never leaves a truncated file behind."""
+
+    tmp_path = f"{path}.tmp"
+
+    try:
+
+        with open(tmp_path, mode) as f:
+
+            yield f
+
+            f.flush()
+
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    finally:
+
+        if os.path.exists(tmp_path):
+
+            os.remove(tmp_path)
+
+
+
+class MappedDocumentStore:
+
+    """Read-only document store over a JSONL file and its offset index.
+
+    
+
+    documents.jsonl holds one JSON record per chunk; documents.idx holds the
+
+    n + 1 little-endian uint64 record offsets. Both are memory-mapped, so
+
+    worker processes opening the same store share one copy through the page
+
+    cache and a Document is decoded only when its id is looked up. JSON
+
+    escapes newlines, so a missing or stale index is rebuilt by scanning
+
+    the JSONL file for line ends.
+
+    """
 
-    def __init__(self, dimension: int, index_type: str = "L2"):
+    def __init__(self, data_path: str, offsets_path: str):
 
-        if index_type == "L2":
+        self._file = open(data_path, "rb")
 
-            self.index = faiss.IndexFlatL2(dimension)
+        # mmap refuses empty files; an empty store has nothing to map
 
-        elif index_type == "IVF":
+        if os.fstat(self._file.fileno()).st_size:
 
-            quantizer = faiss.IndexFlatL2(dimension)
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
 
-            self.index = faiss.IndexIVFFlat(quantizer, dimension, 100)
+        else:
+
+            self.data = b""
 
             
 
-    def add_documents(self, embeddings: np.ndarray):
+        self.offsets = None
+
+        if os.path.exists(offsets_path) and os.path.getsize(offsets_path):
+
+            self.offsets = np.memmap(offsets_path, dtype="<u8", mode="r")
+
+        if self.offsets is None or int(self.offsets[-1]) != len(self.data):
+
+            logger.warning("Rebuilding stale offset index for %s", data_path)
+
+            line_ends = np.flatnonzero(np.frombuffer(self.data, dtype=np.uint8) == ord("\n")) + 1
+
+            self.offsets = np.concatenate([[0], line_ends]).astype("<u8")
+
+            
 
-        """Add document embeddings to the FAISS index"""
+    @staticmethod
 
-        if isinstance(self.index, faiss.IndexIVFFlat) and not self.index.is_trained:
+    def write(documents: Iterable[Document], data_path: str, offsets_path: str,
 
-            self.index.train(embeddings)
+              block_size: int = 65536):
 
-        self.index.add(embeddings)
+        """Stream documents into a store that MappedDocumentStore can open
 
         
 
-    def search(self, query_embedding: np.ndarray, k: int = 5) -> tuple:
+        Records and offsets are written as they are produced, so the full
 
-        """Search for similar documents"""
+        document list is never built. Each file is replaced atomically; the
 
-        distances, indices = self.index.search(query_embedding.reshape(1, -1), k)
+        data file goes first, and a reader that finds the old index rebuilds it.
 
-        return distances[0], indices[0]
+        """
 
-    
+        # The inner (data) file is renamed into place first
 
-    def save(self, filepath: str):
+        with atomic_write(offsets_path) as index, atomic_write(data_path) as data:
 
-        """Save FAISS index to disk"""
+            offsets = array("Q", [0])
 
-        faiss.write_index(self.index, filepath)
+            position = 0
 
-        
+            for doc in documents:
 
-    def load(self, filepath: str):
+                record = json.dumps({"text": doc.text, "metadata": doc.metadata}).encode("utf-8") + b"\n"
 
-        """Load FAISS index from disk"""
+                data.write(record)
 
-        self.index = faiss.read_index(filepath)
+                position += len(record)
 
+                offsets.append(position)
 
+                if len(offsets) >= block_size:
 
-class RAGSystem:
+                    np.asarray(offsets, dtype="<u8").tofile(index)
 
-    def __init__(self, chunker: HybridChunker, encoder: HybridEncoder, 
+                    offsets = array("Q")
 
-                 dimension: int = 768):
+            np.asarray(offsets, dtype="<u8").tofile(index)
 
-        self.chunker = chunker
+        
 
-        self.encoder = encoder
+    def __len__(self) -> int:
+
+        return len(self.offsets) - 1
+
+    
 
-        self.index = FAISSIndex(dimension)
+    def __getitem__(self, idx: int) -> Document:
 
-        self.documents = []
+        idx = int(idx)
+
+        if idx < 0:
+
+            idx += len(self)
+
+        if not 0 <= idx < len(self):
+
+            raise IndexError("document id out of range")
 
         
 
-    def add_documents(self, texts: List[str]):
+        record = json.loads(self.data[int(self.offsets[idx]):int(self.offsets[idx + 1])])
 
-        """Process and index new documents"""
+        return Document(text=record["text"], metadata=record["metadata"])
 
-        for text in texts:
+    
 
-            # Chunk documents
+    def __iter__(self) -> Iterator[Document]:
 
-            chunks = self.chunker.chunk_text(text)
+        for idx in range(len(self)):
 
-            self.documents.extend(chunks)
+            yield self[idx]
 
             
 
-            # Encode chunks
+    def close(self):
 
-            embeddings = self.encoder.encode_documents(chunks)
+        if isinstance(self.data, mmap.mmap):
 
-            
+            self.data.close()
+
+        self._file.close()
+
+
+
+class HybridChunker:
+
+    SEGMENTERS = ("full", "parser", "sentencizer", "regex")
+
+    # en_core_web_* components that sentence segmentation never reads
+
+    _UNUSED_PIPES = ["tagger", "attribute_ruler", "lemmatizer", "ner", "senter"]
 
-            # Add to index
+    # Terminal punctuation (plus closing quotes/brackets) followed by whitespace,
 
-            self.index.add_documents(embeddings)
+    # or the last character before a blank line
+
+    _SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*(?=\s)|\S(?=[ \t]*\n\s*\n)")
 
     
 
-    def search(self, query: str, k: int = 5) -> List[Document]:
+    def __init__(self, language="en_core_web_sm", segmenter: str = "full",
+
+                 tokenizer_name: Optional[str] = None, max_seq_length: int = 384):
+
+        """segmenter: "full" (default), "parser", "sentencizer" or "regex" (no spaCy).
+
+        tokenizer_name: measure chunks in that tokenizer's tokens, capped at max_seq_length.
+
+        """
+
+        if segmenter not in self.SEGMENTERS:
+
+            raise ValueError(f"Unknown segmenter {segmenter!r}, expected one of {self.SEGMENTERS}")
+
+        self.segmenter = segmenter
 
-        """Search for relevant documents"""
+        # Enough to build an equivalent chunker, e.g. in a worker process
 
-        # Encode query
+        self.config = {"language": language, "segmenter": segmenter,
 
-        query_embedding = self.encoder.encode_documents([Document(text=query)])[0]
+                       "tokenizer_name": tokenizer_name, "max_seq_length": max_seq_length}
 
         
 
-        # Search index
+        if segmenter == "full":
+
+            self.nlp = spacy.load(language)
+
+        elif segmenter == "parser":
+
+            self.nlp = spacy.load(language, exclude=self._UNUSED_PIPES)
+
+        elif segmenter == "sentencizer":
+
+            self.nlp = spacy.load(language, exclude=self._UNUSED_PIPES + ["tok2vec", "parser"])
+
+            self.nlp.add_pipe("sentencizer")
+
+            # max_length guards parser/NER memory; the sentencizer is linear
+
+            self.nlp.max_length = 10 ** 9
 
-        distances, indices = self.index.search(query_embedding, k)
+        else:
+
+            self.nlp = None
 
         
 
-        # Return matched documents
+        self.tokenizer = None
 
-        return [self.documents[idx] for idx in indices]
+        self.token_budget = None
 
-    
+        if tokenizer_name is not None:
 
-    def save(self, directory: str):
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
 
-        """Save the entire RAG system"""
+            self.token_budget = max_seq_length - self.tokenizer.num_special_tokens_to_add()
 
-        os.makedirs(directory, exist_ok=True)
+        
+
+    def _get_semantic_boundaries(self, text: str) -> List[int]:
+
+        """Find semantic boundaries using the configured segmenter"""
+
+        if self.nlp is None:
+
+            return self._get_regex_boundaries(text)
 
         
 
-        # Save FAISS index
+        return self._doc_boundaries(self.nlp(text))
 
-        self.index.save(os.path.join(directory, "index.faiss"))
+    
+
+    def _doc_boundaries(self, doc) -> List[int]:
+
+        """Read sentence boundaries off a processed spaCy Doc"""
+
+        boundaries = [0]
 
         
 
-        # Save documents
+        for sent in doc.sents:
 
-        documents_data = [
+            # Check for semantic completeness using dependency parsing; the
 
-            {"text": doc.text, "metadata": doc.metadata}
+            # sentencizer sets no dependencies, so each of its sentences counts
 
-            for doc in self.documents
+            if self.segmenter == "sentencizer" or sent.root.dep_ in ["ROOT"]:
 
-        ]
+                boundaries.append(sent.end_char)
 
-        with open(os.path.join(directory, "documents.json"), "w") as f:
+                
 
-            json.dump(documents_data, f)
+        return boundaries
 
     
 
-    def load(self, directory: str):
+    def _get_regex_boundaries(self, text: str) -> List[int]:
 
-        """Load the entire RAG system"""
+        """Find sentence ends with _SENTENCE_END, matching spaCy's end_char offsets"""
 
-        # Load FAISS index
+        boundaries = [0]
+
+        boundaries.extend(match.end() for match in self._SENTENCE_END.finditer(text))
+
+        
+
+        # Like doc.sents, the last sentence ends at the final non-space character
+
+        text_end = len(text.rstrip())
+
+        if text_end > boundaries[-1]:
+
+            boundaries.append(text_end)
 
-        self.index.load(os.path.join(directory, "index.faiss"))
+            
+
+        return boundaries
+
+    
+
+    def _chunk_spans(self, text: str, boundaries: List[int], max_chunk_size: int,
+
+                     overlap: int) -> List[Tuple[int, int]]:
+
+        """Walk the sorted boundaries and return (start, end) offsets of each chunk
+
+        
+
+        Every step moves the start forward by at least half the window minus
+
+        the overlap, so consecutive chunks share at most overlap units and
+
+        the walk always ends: a boundary too close to the start is passed
+
+        over for a cut at the window's end, and stepping back by the overlap
+
+        never returns to (or before) the previous start.
+
+        """
+
+        if self.tokenizer is None:
+
+            window = max_chunk_size
+
+            window_end = lambda pos, size=window: pos + size
+
+            step_back = lambda end: end - overlap
+
+        else:
+
+            window = min(max_chunk_size, self.token_budget)
+
+            window_end, step_back = self._token_window(text, window, overlap)
+
+        if window <= 0:
+
+            raise ValueError(f"max_chunk_size must be positive, got {max_chunk_size}")
+
+        if not 0 <= overlap < window:
+
+            raise ValueError(f"overlap must be at least 0 and below the chunk size ({window}), got {overlap}")
+
+        min_stride = max(1, (window - overlap) // 2)
+
+        
+
+        spans = []
+
+        current_pos = 0
+
+        # Trailing whitespace never forms a chunk of its own
+
+        text_end = len(text.rstrip())
 
         
 
-        # Load documents
+        while current_pos < len(text):
+
+            # Pick the last semantic boundary within max_chunk_size; boundaries
+
+            # are sorted, so a bisect replaces the scan over every sentence
+
+            chunk_end = min(window_end(current_pos), len(text))
+
+            earliest = window_end(current_pos, min_stride)
+
+            best_boundary = chunk_end
+
+            
+
+            idx = bisect_right(boundaries, chunk_end) - 1
+
+            if idx >= 0 and boundaries[idx] >= min(earliest, text_end) and boundaries[idx] > current_pos:
+
+                best_boundary = boundaries[idx]
+
+                
+
+            spans.append((current_pos, best_boundary))
+
+            
+
+            # Once the rest of the text is covered, stepping back by the overlap
+
+            # would only land on the same final boundary again
+
+            if best_boundary >= text_end:
+
+                break
+
+            
+
+            # Move position considering overlap, but always by the minimum stride
+
+            current_pos = min(max(step_back(best_boundary), earliest), best_boundary)
+
+            
+
+        return spans
+
+    
+
+    def _token_window(self, text: str, max_tokens: int, overlap: int):
+
+        """Build window_end/step_back functions that measure in encoder tokens.
+
+        
+
+        The text is tokenized once; both functions then map between character
+
+        offsets and token positions by bisecting the token offset table.
+
+        """
+
+        encoding = self.tokenizer(text, add_special_tokens=False,
+
+                                  return_offsets_mapping=True, verbose=False)
+
+        token_starts = [start for start, _ in encoding["offset_mapping"]]
+
+        token_ends = [end for _, end in encoding["offset_mapping"]]
+
+        
+
+        def window_end(pos: int, size: int = max_tokens) -> int:
+
+            # Character offset just past the size-th token after pos
+
+            last = bisect_right(token_ends, pos) + size
+
+            return token_ends[last - 1] if last <= len(token_ends) else len(text)
+
+        
+
+        def step_back(end: int) -> int:
+
+            # Start of the token overlap tokens before end
+
+            first = bisect_right(token_ends, end) - overlap
+
+            if overlap <= 0 or first >= len(token_starts):
+
+                return end
+
+            return token_starts[max(first, 0)]
+
+        
+
+        return window_end, step_back
+
+    
+
+    def _build_chunks(self, text: str, boundaries: List[int], max_chunk_size: int,
+
+                      overlap: int) -> List[Document]:
+
+        chunks = []
+
+        
+
+        for start, end in self._chunk_spans(text, boundaries, max_chunk_size, overlap):
+
+            # Create chunk
+
+            chunk_text = text[start:end].strip()
+
+            if chunk_text:
+
+                chunks.append(Document(
+
+                    text=chunk_text,
+
+                    metadata={"start": start, "end": end}
+
+                ))
+
+            
+
+        return chunks
+
+    
+
+    def chunk_text(self, text: str, max_chunk_size: int = 512, 
+
+                   overlap: int = 50) -> List[Document]:
+
+        """Create chunks using both fixed-size and semantic boundaries
+
+        
+
+        max_chunk_size and overlap are characters, or encoder tokens when the
+
+        chunker was built with tokenizer_name.
+
+        """
+
+        semantic_boundaries = self._get_semantic_boundaries(text)
+
+        return self._build_chunks(text, semantic_boundaries, max_chunk_size, overlap)
+
+    
+
+    def chunk_many(self, texts: Iterable[str], max_chunk_size: int = 512, overlap: int = 50,
+
+                   n_process: int = 1, batch_size: int = 64) -> Iterator[List[Document]]:
+
+        """Chunk a stream of texts, yielding one list of chunks per text in order.
+
+        
+
+        Segmentation goes through nlp.pipe, so n_process > 1 (or -1 for every
+
+        core) spreads the spaCy work across worker processes. The regex
+
+        segmenter is cheaper than shipping texts between processes and always
+
+        runs in-process.
+
+        """
+
+        if self.nlp is None:
+
+            for text in texts:
+
+                yield self.chunk_text(text, max_chunk_size, overlap)
+
+            return
+
+        
+
+        for doc in self.nlp.pipe(texts, n_process=n_process, batch_size=batch_size):
+
+            yield self._build_chunks(doc.text, self._doc_boundaries(doc),
+
+                                     max_chunk_size, overlap)
+
+
+
+    def chunk_stream(self, source: Union[str, os.PathLike, IO[str], Iterable[str]],
+
+                     max_chunk_size: int = 512, overlap: int = 50,
+
+                     window_size: int = 1_000_000) -> Iterator[Document]:
+
+        """Lazily chunk a file path, open text file or iterator of strings.
+
+        
+
+        Text is segmented window_size characters at a time. The last chunk of
+
+        each window may still grow once more text arrives, so it is held back
+
+        and the next window resumes from its start. Memory therefore stays
+
+        around window_size however large the input is, and metadata offsets
+
+        are relative to the start of the stream. window_size may not exceed
+
+        the spaCy pipeline's max_length.
+
+        """
+
+        if self.nlp is not None and window_size > self.nlp.max_length:
+
+            raise ValueError(f"window_size {window_size} exceeds the spaCy pipeline's "
+
+                             f"max_length ({self.nlp.max_length})")
+
+        buffer = ""
+
+        pending = ""
+
+        base = 0
+
+        windows = self._read_windows(source, window_size)
+
+        exhausted = False
+
+        
+
+        while not exhausted:
+
+            # Top the carried chunk up to exactly window_size characters, so
+
+            # segmentation never sees more than max_length at once
+
+            while len(buffer) < window_size:
+
+                if not pending:
+
+                    pending = next(windows, None)
+
+                    if pending is None:
+
+                        exhausted = True
+
+                        break
+
+                room = window_size - len(buffer)
+
+                buffer += pending[:room]
+
+                pending = pending[room:]
+
+            
+
+            boundaries = self._get_semantic_boundaries(buffer)
+
+            spans = self._chunk_spans(buffer, boundaries, max_chunk_size, overlap)
+
+            if not exhausted:
+
+                # Carry the provisional last chunk into the next window, unless
+
+                # it starts the window: carrying it would leave no room to grow
+
+                resume = spans[-1][0] or spans[-1][1]
+
+                spans = spans[:-1] if spans[-1][0] else spans
+
+                
+
+            for start, end in spans:
+
+                chunk_text = buffer[start:end].strip()
+
+                if chunk_text:
+
+                    yield Document(
+
+                        text=chunk_text,
+
+                        metadata={"start": base + start, "end": base + end}
+
+                    )
+
+            
+
+            if not exhausted:
+
+                buffer = buffer[resume:]
+
+                base += resume
+
+    
+
+    @staticmethod
+
+    def _read_windows(source, window_size: int) -> Iterator[str]:
+
+        if isinstance(source, (str, os.PathLike)):
+
+            with open(source, "r", encoding="utf-8") as f:
+
+                yield from iter(lambda: f.read(window_size), "")
+
+        elif hasattr(source, "read"):
+
+            yield from iter(lambda: source.read(window_size), "")
+
+        else:
+
+            yield from source
+
+
+
+# Chunker of an ingest worker process, built once by _init_chunk_worker
+
+_worker_chunker: Optional[HybridChunker] = None
+
+
+
+def _init_chunk_worker(config: Dict[str, Any]):
+
+    global _worker_chunker
+
+    _worker_chunker = HybridChunker(**config)
+
+
+
+def _chunk_worker(texts: List[str]) -> Tuple[List[List[Document]], float]:
+
+    """Chunks of each text, and the seconds it took"""
+
+    start = time.perf_counter()
+
+    chunks = list(_worker_chunker.chunk_many(texts))
+
+    return chunks, time.perf_counter() - start
+
+
+
+class EmbeddingCache:
+
+    """On-disk embedding cache backed by SQLite.
+
+    
+
+    Entries are keyed by a SHA-256 of the model name and text, so a changed
+
+    chunk or a different model never reuses a stale vector. Every lookup
+
+    stamps the entry with a logical clock and the oldest stamps are evicted
+
+    once the cache holds more than max_entries vectors.
+
+    """
+
+    # Stay under SQLite's bound-parameter limit on older builds
+
+    _BATCH = 500
+
+    
+
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+
+        self.max_entries = max_entries
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+        self.conn.execute("PRAGMA journal_mode=WAL")
+
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+
+                          "(key BLOB PRIMARY KEY, vector BLOB NOT NULL, used INTEGER NOT NULL)")
+
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+
+        self._clock = self.conn.execute("SELECT MAX(used) FROM embeddings").fetchone()[0] or 0
+
+        # Counted once here, then kept up to date by put_many
+
+        self._count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        
+
+    @staticmethod
+
+    def key(model_name: str, text: str) -> bytes:
+
+        return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).digest()
+
+    
+
+    def get_many(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+
+        """Return the cached vectors among keys and mark them recently used"""
+
+        found = {}
+
+        with self._lock:
+
+            for i in range(0, len(keys), self._BATCH):
+
+                batch = keys[i:i + self._BATCH]
+
+                placeholders = ",".join("?" * len(batch))
+
+                rows = self.conn.execute(
+
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch)
+
+                for key, vector in rows:
+
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+
+            
+
+            self._clock += 1
+
+            self.conn.executemany("UPDATE embeddings SET used = ? WHERE key = ?",
+
+                                  [(self._clock, key) for key in found])
+
+            self.conn.commit()
+
+            hits = sum(key in found for key in keys)
+
+            self.hits += hits
+
+            self.misses += len(keys) - hits
+
+        return found
+
+    
+
+    def put_many(self, keys: List[bytes], vectors: np.ndarray):
+
+        """Store float32 vectors under keys, evicting least recently used entries"""
+
+        with self._lock:
+
+            self._clock += 1
+
+            rows = [(np.ascontiguousarray(vector, dtype=np.float32).tobytes(), self._clock, key)
+
+                    for key, vector in zip(keys, vectors)]
+
+            # Insert new keys, counting them, then refresh the ones already present
+
+            changes = self.conn.total_changes
+
+            self.conn.executemany("INSERT OR IGNORE INTO embeddings (vector, used, key) VALUES (?, ?, ?)", rows)
+
+            inserted = self.conn.total_changes - changes
+
+            if inserted < len(rows):
+
+                self.conn.executemany("UPDATE embeddings SET vector = ?, used = ? WHERE key = ?", rows)
+
+            self._count += inserted
+
+            
+
+            excess = self._count - self.max_entries
+
+            if excess > 0:
+
+                evicted = self.conn.execute("DELETE FROM embeddings WHERE key IN "
+
+                                            "(SELECT key FROM embeddings ORDER BY used LIMIT ?)", (excess,))
+
+                self._count -= evicted.rowcount
+
+            self.conn.commit()
+
+            
+
+    def close(self):
+
+        self.conn.close()
+
+
+
+class HybridEncoder:
+
+    OUTPUT_DTYPES = ("float32", "float16", "int8")
+
+    BACKENDS = ("torch", "onnx", "int8")
+
+    
+
+    def __init__(self, model_name: str = "sentence-transformers/all-mpnet-base-v2",
+
+                 device: Optional[str] = None, batch_size: int = 64,
+
+                 cache_path: Optional[str] = None, cache_size: int = 1_000_000,
+
+                 backend: str = "torch"):
+
+        """backend: "torch" (default), "onnx" or "int8" (CPU only).
+
+        cache_path: keep up to cache_size embeddings in an EmbeddingCache.
+
+        """
+
+        if backend not in self.BACKENDS:
+
+            raise ValueError(f"Unknown backend {backend!r}, expected one of {self.BACKENDS}")
+
+        if backend == "int8":
+
+            # Dynamically quantized Linear layers only have CPU kernels
+
+            if device not in (None, "cpu"):
+
+                raise ValueError(f"The int8 backend runs on the CPU only, got device={device!r}")
+
+            device = "cpu"
+
+        
+
+        if backend == "onnx":
+
+            self.model = SentenceTransformer(model_name, device=device, backend="onnx")
+
+        else:
+
+            self.model = SentenceTransformer(model_name, device=device)
+
+        if backend == "int8":
+
+            torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear},
+
+                                                dtype=torch.qint8, inplace=True)
+
+        self.backend = backend
+
+        self.model_name = model_name
+
+        # Backends differ numerically, so they must not share cached vectors
+
+        self.cache_namespace = model_name if backend == "torch" else f"{model_name}#{backend}"
+
+        self.batch_size = batch_size
+
+        self.cache = EmbeddingCache(cache_path, cache_size) if cache_path else None
+
+        # Running totals across encode_documents calls
+
+        self.stats = {"texts": 0, "seconds": 0.0}
+
+        
+
+    def encode_documents(self, documents: List[Document], batch_size: Optional[int] = None,
+
+                         dtype: str = "float32", show_progress_bar: bool = False,
+
+                         use_cache: bool = True) -> np.ndarray:
+
+        """Encode documents using the SentenceTransformer model
+
+        
+
+        SentenceTransformer.encode sorts texts by length before batching, so
+
+        passing a whole ingest batch in one call keeps padding per batch low.
+
+        dtype "float16" halves the output; "int8" scales unit-normalized
+
+        vectors to [-127, 127] for compact storage. FAISS needs "float32".
+
+        use_cache=False bypasses the EmbeddingCache, e.g. for one-off queries.
+
+        """
+
+        if dtype not in self.OUTPUT_DTYPES:
+
+            raise ValueError(f"Unknown dtype {dtype!r}, expected one of {self.OUTPUT_DTYPES}")
+
+        texts = [doc.text for doc in documents]
+
+        
+
+        if self.cache is None or not use_cache or not texts:
+
+            embeddings = self._encode(texts, batch_size, show_progress_bar)
+
+        else:
+
+            # Only texts the cache has never seen reach the model
+
+            keys = [EmbeddingCache.key(self.cache_namespace, text) for text in texts]
+
+            cached = self.cache.get_many(keys)
+
+            text_by_key = dict(zip(keys, texts))
+
+            missing = [key for key in text_by_key if key not in cached]
+
+            
+
+            if missing:
+
+                fresh = self._encode([text_by_key[key] for key in missing],
+
+                                     batch_size, show_progress_bar)
+
+                self.cache.put_many(missing, fresh)
+
+                cached.update(zip(missing, fresh))
+
+            embeddings = np.stack([cached[key] for key in keys])
+
+        
+
+        return self._convert(embeddings, dtype)
+
+    
+
+    def _encode(self, texts: List[str], batch_size: Optional[int],
+
+                show_progress_bar: bool) -> np.ndarray:
+
+        start = time.perf_counter()
+
+        embeddings = self.model.encode(texts, batch_size=batch_size or self.batch_size,
+
+                                       convert_to_numpy=True,
+
+                                       show_progress_bar=show_progress_bar)
+
+        elapsed = time.perf_counter() - start
+
+        
+
+        self.stats["texts"] += len(texts)
+
+        self.stats["seconds"] += elapsed
+
+        logger.debug("Encoded %d texts in %.2fs (%.0f texts/sec)",
+
+                     len(texts), elapsed, len(texts) / elapsed if elapsed else 0.0)
+
+        
+
+        return np.asarray(embeddings, dtype=np.float32)
+
+    
+
+    @property
+
+    def throughput(self) -> float:
+
+        """Texts encoded per second over the encoder's lifetime"""
+
+        seconds = self.stats["seconds"]
+
+        return self.stats["texts"] / seconds if seconds else 0.0
+
+    
+
+    @staticmethod
+
+    def _convert(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+
+        if dtype == "float16":
+
+            return embeddings.astype(np.float16)
+
+        if dtype == "int8":
+
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+            unit = embeddings / np.maximum(norms, 1e-12)
+
+            return np.clip(np.rint(unit * 127), -127, 127).astype(np.int8)
+
+        return embeddings
+
+
+
+class EmbeddingBuffer:
+
+    """Growable float32 matrix (plus int64 ids) for embeddings awaiting a
+
+    bulk index add.
+
+    
+
+    Rows live in a preallocated array that doubles when full, or in a
+
+    memory-mapped file when path is given so large ingests need not fit in
+
+    RAM.
+
+    """
+
+    def __init__(self, dimension: int, capacity: int = 65536, path: Optional[str] = None):
+
+        self.dimension = dimension
+
+        self.path = path
+
+        self.size = 0
+
+        self.data = self._allocate(capacity)
+
+        self.ids = np.empty(capacity, dtype=np.int64)
+
+        
+
+    def _allocate(self, capacity: int) -> np.ndarray:
+
+        if self.path is None:
+
+            data = np.empty((capacity, self.dimension), dtype=np.float32)
+
+            if self.size:
+
+                data[:self.size] = self.data[:self.size]
+
+            return data
+
+        
+
+        # Growing the file keeps the rows already written
+
+        if self.size:
+
+            self.data.flush()
+
+            del self.data
+
+        mode = "r+b" if self.size else "w+b"
+
+        with open(self.path, mode) as f:
+
+            f.truncate(capacity * self.dimension * 4)
+
+        return np.memmap(self.path, dtype=np.float32, mode="r+",
+
+                         shape=(capacity, self.dimension))
+
+    
+
+    def append(self, embeddings: np.ndarray, ids: np.ndarray):
+
+        needed = self.size + len(embeddings)
+
+        if needed > len(self.data):
+
+            capacity = max(needed, 2 * len(self.data))
+
+            self.data = self._allocate(capacity)
+
+            self.ids = np.resize(self.ids, capacity)
+
+        self.data[self.size:needed] = embeddings
+
+        self.ids[self.size:needed] = ids
+
+        self.size = needed
+
+        
+
+    def drop(self, ids: np.ndarray) -> int:
+
+        """Mark rows with these ids as removed (id -1); returns how many"""
+
+        mask = np.isin(self.ids[:self.size], ids)
+
+        self.ids[:self.size][mask] = -1
+
+        return int(mask.sum())
+
+        
+
+    def blocks(self, block_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+
+        """(embeddings, ids) blocks of live rows"""
+
+        for start in range(0, self.size, block_size):
+
+            stop = min(start + block_size, self.size)
+
+            live = self.ids[start:stop] >= 0
+
+            yield np.ascontiguousarray(self.data[start:stop][live]), self.ids[start:stop][live]
+
+            
+
+    def __len__(self) -> int:
+
+        return self.size
+
+    
+
+    def clear(self):
+
+        self.size = 0
+
+
+
+class FAISSIndex:
+
+    INDEX_TYPES = ("L2", "IVF", "HNSW", "IVFPQ")
+
+    METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT}
+
+    # Types whose structure is trained on the data; built by build()
+
+    TRAINED_TYPES = ("IVF", "IVFPQ")
+
+    TRANSFORMS = ("pca", "opq")
+
+    
+
+    def __init__(self, dimension: int, index_type: str = "L2", nlist: Optional[int] = None,
+
+                 pq_m: Optional[int] = None, hnsw_m: int = 32, ef_construction: int = 200,
+
+                 nprobe: Optional[int] = None, ef_search: int = 64, sample_size: int = 100_000,
+
+                 add_block_size: int = 65536, buffer_path: Optional[str] = None,
+
+                 metric: str = "l2", reduce_dim: Optional[int] = None, transform: str = "pca"):
+
+        """index_type: "L2" (default), "IVF", "HNSW" or "IVFPQ"; metric: "l2" or "ip" (cosine).
+
+        reduce_dim: project vectors to that many dimensions with transform "pca" or "opq".
+
+        
+
+        Trained indexes (IVF, IVFPQ, reduce_dim) are built from a sample of
+
+        sample_size vectors by build(); until then added vectors are searched exactly.
+
+        """
+
+        if index_type not in self.INDEX_TYPES:
+
+            raise ValueError(f"Unknown index_type {index_type!r}, expected one of {self.INDEX_TYPES}")
+
+        if metric not in self.METRICS:
+
+            raise ValueError(f"Unknown metric {metric!r}, expected one of {tuple(self.METRICS)}")
+
+        if transform not in self.TRANSFORMS:
+
+            raise ValueError(f"Unknown transform {transform!r}, expected one of {self.TRANSFORMS}")
+
+        if reduce_dim is not None and not 0 < reduce_dim < dimension:
+
+            raise ValueError(f"reduce_dim must be between 1 and {dimension - 1}, got {reduce_dim}")
+
+        self.dimension = dimension
+
+        self.index_type = index_type
+
+        self.metric = metric
+
+        self.nlist = nlist
+
+        self.pq_m = pq_m
+
+        self.hnsw_m = hnsw_m
+
+        self.ef_construction = ef_construction
+
+        self.reduce_dim = reduce_dim
+
+        self.transform = transform
+
+        self.nprobe = nprobe
+
+        self.ef_search = ef_search
+
+        self.sample_size = sample_size
+
+        self.add_block_size = add_block_size
+
+        self.buffer_path = buffer_path
+
+        
+
+        self.index = None
+
+        self._pending: Optional[EmbeddingBuffer] = None
+
+        self._deferred = False
+
+        self._sample = None
+
+        self._seen = 0
+
+        self._next_id = 0
+
+        self._rng = np.random.default_rng(0)
+
+        # search_many builds lazily, possibly from several threads at once
+
+        self._build_lock = threading.RLock()
+
+        if sample_size < self._min_train():
+
+            raise ValueError(f"sample_size must be at least {self._min_train()} to train this index, "
+
+                             f"got {sample_size}")
+
+        
+
+        if index_type not in self.TRAINED_TYPES and reduce_dim is None:
+
+            self.index = faiss.IndexIDMap(self._inner_index(dimension, 0))
+
+            
+
+    def add_documents(self, embeddings: np.ndarray, ids: Optional[np.ndarray] = None):
+
+        """Add document embeddings to the FAISS index under ids (default: the
+
+        next unused ids)"""
+
+        embeddings = self._prepare(embeddings)
+
+        # A concurrent build() swaps the index in and drains the buffer
+
+        with self._build_lock:
+
+            if ids is None:
+
+                ids = np.arange(self._next_id, self._next_id + len(embeddings))
+
+            ids = np.ascontiguousarray(ids, dtype=np.int64)
+
+            if len(ids):
+
+                self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+            
+
+            if self.index is None or self._deferred:
+
+                # Trained types wait for the whole ingest before training
+
+                if self.index is None:
+
+                    self._update_sample(embeddings)
+
+                if self._pending is None:
+
+                    self._pending = EmbeddingBuffer(self.dimension, path=self.buffer_path)
+
+                self._pending.append(embeddings, ids)
+
+            else:
+
+                self._add(embeddings, ids)
+
+            
+
+    def _add(self, embeddings: np.ndarray, ids: np.ndarray):
+
+        if self._has_ids():
+
+            self.index.add_with_ids(embeddings, ids)
+
+        else:
+
+            # Indexes saved before ids were tracked number vectors by position
+
+            self.index.add(embeddings)
+
+            
+
+    def _has_ids(self) -> bool:
+
+        return (isinstance(self.index, faiss.IndexIDMap)
+
+                or faiss.try_extract_index_ivf(self.index) is not None)
+
+    
+
+    def _base_index(self):
+
+        """The concrete index under any IndexIDMap and transform wrappers"""
+
+        index = self.index
+
+        if isinstance(index, faiss.IndexIDMap):
+
+            index = index.index
+
+        index = faiss.downcast_index(index)
+
+        if isinstance(index, faiss.IndexPreTransform):
+
+            index = faiss.downcast_index(index.index)
+
+        return index
+
+    
+
+    def remove_ids(self, ids: Iterable[int]) -> int:
+
+        """Remove vectors by id; returns how many were actually removed
+
+        
+
+        HNSW graphs and indexes saved without ids cannot drop vectors, so
+
+        for those nothing is removed and callers must filter the ids out.
+
+        """
+
+        ids = np.asarray(list(ids), dtype=np.int64)
+
+        removed = 0
+
+        if self._pending is not None and len(self._pending):
+
+            removed += self._pending.drop(ids)
+
+        if self.index is None or not self._has_ids() or isinstance(self._base_index(), faiss.IndexHNSW):
+
+            return removed
+
+        return removed + self.index.remove_ids(ids)
+
+            
+
+    def bytes_per_vector(self) -> int:
+
+        """Approximate index memory per stored vector: its code plus its id"""
+
+        if self.index is None:
+
+            # Not trained yet; assume uncompressed float32 vectors
+
+            return (self.reduce_dim or self.dimension) * 4 + 8
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+
+        if ivf is not None:
+
+            return ivf.code_size + 8
+
+        base = self._base_index()
+
+        if isinstance(base, faiss.IndexHNSW):
+
+            # The stored vector plus its level-0 neighbour links
+
+            return faiss.downcast_index(base.storage).sa_code_size() + base.hnsw.nb_neighbors(0) * 4 + 8
+
+        return base.sa_code_size() + 8
+
+    
+
+    def _prepare(self, embeddings: np.ndarray) -> np.ndarray:
+
+        """float32, C-contiguous and, for inner product, unit-normalized rows"""
+
+        if self.metric != "ip":
+
+            return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        # Normalize a private copy in one vectorized pass
+
+        embeddings = np.array(embeddings, dtype=np.float32, order="C")
+
+        faiss.normalize_L2(embeddings)
+
+        return embeddings
+
+    
+
+    def defer(self, enabled: bool = True):
+
+        """Buffer every added embedding until build(); switching off builds"""
+
+        self._deferred = enabled
+
+        if not enabled:
+
+            self.build()
+
+            
+
+    def _update_sample(self, embeddings: np.ndarray):
+
+        """Reservoir-sample (algorithm R, vectorized per batch) the training set"""
+
+        if self._sample is None:
+
+            self._sample = np.empty((self.sample_size, self.dimension), dtype=np.float32)
+
+        
+
+        # Fill the reservoir first, then replace entries with falling probability
+
+        filled = min(self._seen, self.sample_size)
+
+        take = min(self.sample_size - filled, len(embeddings))
+
+        self._sample[filled:filled + take] = embeddings[:take]
+
+        
+
+        rest = embeddings[take:]
+
+        if len(rest):
+
+            positions = np.arange(self._seen + take, self._seen + len(embeddings)) + 1
+
+            slots = (self._rng.random(len(rest)) * positions).astype(np.int64)
+
+            keep = slots < self.sample_size
+
+            self._sample[slots[keep]] = rest[keep]
+
+        self._seen += len(embeddings)
+
+        
+
+    def build(self):
+
+        """Train a deferred IVF/IVFPQ index on the sample, then add held-back vectors"""
+
+        # Concurrent callers wait here, then find the index already built
+
+        with self._build_lock:
+
+            if self.index is None:
+
+                sample = self._sample[:min(self._seen, self.sample_size)] if self._seen else None
+
+                if sample is None or len(sample) < self._min_train():
+
+                    # Too little to train on; searches scan the held-back vectors
+
+                    return
+
+                # Derived settings are recorded on the instance; a failed attempt
+
+                # must not pin them to this sample's size
+
+                settings = self.nlist, self.pq_m
+
+                try:
+
+                    index = self._trained_index(len(sample))
+
+                    index.train(sample)
+
+                except Exception:
+
+                    # Stay unbuilt, so a later build() retrains with more data
+
+                    self.nlist, self.pq_m = settings
+
+                    raise
+
+                self.index = index
+
+                self._sample = None
+
+            self.flush()
+
+        
+
+    def flush(self):
+
+        """Add held-back vectors to an already built index in large blocks"""
+
+        with self._build_lock:
+
+            if self.index is None or self._pending is None:
+
+                return
+
+            for embeddings, ids in self._pending.blocks(self.add_block_size):
+
+                self._add(embeddings, ids)
+
+            self._pending.clear()
+
+        
+
+    def _trained_index(self, n_train: int):
+
+        dimension = self.reduce_dim or self.dimension
+
+        index = self._inner_index(dimension, n_train)
+
+        if self.reduce_dim is not None:
+
+            transform = self._vector_transform(n_train)
+
+            if self.metric == "ip":
+
+                # Projection shrinks the norms; renormalize so that search
+
+                # distances stay cosine similarities
+
+                index = faiss.IndexPreTransform(faiss.NormalizationTransform(dimension, 2.0), index)
+
+                index.prepend_transform(transform)
+
+            else:
+
+                index = faiss.IndexPreTransform(transform, index)
+
+        if faiss.try_extract_index_ivf(index) is None:
+
+            index = faiss.IndexIDMap(index)
+
+        return index
+
+    
+
+    def _inner_index(self, dimension: int, n_train: int):
+
+        """The index proper, over vectors of dimension (after any transform)"""
+
+        metric = self.METRICS[self.metric]
+
+        if self.index_type == "L2":
+
+            return faiss.IndexFlat(dimension, metric)
+
+        if self.index_type == "HNSW":
+
+            hnsw = faiss.IndexHNSWFlat(dimension, self.hnsw_m, metric)
+
+            hnsw.hnsw.efConstruction = self.ef_construction
+
+            return hnsw
+
+        
+
+        # Keep at least 39 training points per centroid, as FAISS recommends
+
+        nlist = self.nlist or int(4 * np.sqrt(self._seen))
+
+        self.nlist = max(1, min(nlist, n_train // 39))
+
+        
+
+        quantizer = faiss.IndexFlat(dimension, metric)
+
+        if self.index_type == "IVF":
+
+            return faiss.IndexIVFFlat(quantizer, dimension, self.nlist, metric)
+
+        
+
+        # 8-bit codes once the sample has 39 points per code, fewer bits for
+
+        # small corpora
+
+        nbits = int(np.clip(np.log2(max(n_train, 1) / 39), 1, 8))
+
+        return faiss.IndexIVFPQ(quantizer, dimension, self.nlist, self._pq_m(dimension), nbits, metric)
+
+    
+
+    def _min_train(self) -> int:
+
+        """Smallest sample build() trains on"""
+
+        # PQ codebooks need 2 ** nbits points; nbits is 1 below 156 vectors
+
+        needed = 2 if self.index_type == "IVFPQ" else 1
+
+        if self.reduce_dim is not None:
+
+            # PCA and OPQ fit reduce_dim output directions; OPQ trains a PQ too
+
+            needed = max(needed, self.reduce_dim, 2 if self.transform == "opq" else 1)
+
+        return needed
+
+    
+
+    def _pq_m(self, dimension: int) -> int:
+
+        # About 16 dimensions per sub-quantizer
+
+        pq_m = self.pq_m or max(1, dimension // 16)
+
+        while dimension % pq_m:
+
+            pq_m -= 1
+
+        self.pq_m = pq_m
+
+        return pq_m
+
+    
+
+    def _vector_transform(self, n_train: int):
+
+        # build() waits for _min_train() vectors, enough for either transform
+
+        if self.transform == "pca":
+
+            return faiss.PCAMatrix(self.dimension, self.reduce_dim)
+
+        # Rotate for the same sub-quantizer split an IVFPQ index will use
+
+        transform = faiss.OPQMatrix(self.dimension, self._pq_m(self.reduce_dim), self.reduce_dim)
+
+        # The rotation is fitted with 8-bit PQ codebooks (256 centroids);
+
+        # fewer bits for small samples, as for IVFPQ
+
+        nbits = int(np.clip(np.log2(n_train), 1, 8))
+
+        if nbits < 8:
+
+            pq = faiss.ProductQuantizer(self.reduce_dim, transform.M, nbits)
+
+            transform.pq = pq
+
+            # FAISS does not own pq; keep it alive as long as the transform
+
+            transform.referenced_objects = [pq]
+
+        return transform
+
+    
+
+    def _search_params(self, nprobe: Optional[int], ef_search: Optional[int]):
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+
+        if ivf is not None:
+
+            # Default to scanning about sqrt(nlist) lists
+
+            nprobe = nprobe or self.nprobe or max(1, int(np.sqrt(ivf.nlist)))
+
+            return faiss.SearchParametersIVF(nprobe=min(nprobe, ivf.nlist))
+
+        if isinstance(self._base_index(), faiss.IndexHNSW):
+
+            return faiss.SearchParametersHNSW(efSearch=ef_search or self.ef_search)
+
+        return None
+
+    
+
+    def search(self, query_embedding: np.ndarray, k: int = 5) -> tuple:
+
+        """Search for similar documents"""
+
+        distances, indices = self.search_many(query_embedding.reshape(1, -1), k)
+
+        return distances[0], indices[0]
+
+    
+
+    def search_many(self, query_embeddings: np.ndarray, k: int = 5,
+
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+
+                    id_mask: Optional[np.ndarray] = None) -> tuple:
+
+        """Search an (n, dimension) matrix of queries in a single FAISS call
+
+        
+
+        Returns (n, k) distance and index arrays; FAISS spreads a batch over
+
+        its OpenMP threads, which single-row searches never do. nprobe and
+
+        ef_search override the instance defaults for this call only.
+
+        id_mask, a boolean array over ids, limits the search to the ids set
+
+        in it, through a FAISS IDSelectorBitmap.
+
+        """
+
+        queries = self._prepare(query_embeddings)
+
+        if not self._deferred:
+
+            # Inside defer() training waits for the whole ingest
+
+            self.build()
+
+        if self.index is None:
+
+            return self._search_pending(queries, k, id_mask)
+
+        found = self._search_index(queries, k, nprobe, ef_search, id_mask)
+
+        if self._pending is None or not len(self._pending):
+
+            return found
+
+        
+
+        # Deferred adds are not in the index yet; merge an exact scan of them
+
+        distances, labels = (np.hstack(pair) for pair in zip(found, self._search_pending(queries, k, id_mask)))
+
+        order = np.argsort(-distances if self.metric == "ip" else distances, axis=1, kind="stable")[:, :k]
+
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(labels, order, axis=1)
+
+    
+
+    def _search_index(self, queries: np.ndarray, k: int, nprobe: Optional[int],
+
+                      ef_search: Optional[int], id_mask: Optional[np.ndarray]) -> tuple:
+
+        params = self._search_params(nprobe, ef_search)
+
+        if id_mask is not None:
+
+            # The selector only points at the bitmap; keep it alive for the search
+
+            bitmap = np.packbits(id_mask, bitorder="little")
+
+            selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+            params = params or faiss.SearchParameters()
+
+            params.sel = selector
+
+        return self.index.search(queries, k, params=params)
+
+    
+
+    def _search_pending(self, queries: np.ndarray, k: int,
+
+                        id_mask: Optional[np.ndarray]) -> tuple:
+
+        """Exact search over the held-back vectors of an index not trained yet"""
+
+        worst = -np.inf if self.metric == "ip" else np.inf
+
+        distances = np.full((len(queries), k), worst, dtype=np.float32)
+
+        labels = np.full((len(queries), k), -1, dtype=np.int64)
+
+        with self._build_lock:
+
+            if self._pending is None:
+
+                return distances, labels
+
+            ids = self._pending.ids[:len(self._pending)]
+
+            live = ids >= 0
+
+            if id_mask is not None:
+
+                live &= ids < len(id_mask)
+
+                live[live] = id_mask[ids[live]]
+
+            vectors = np.ascontiguousarray(self._pending.data[:len(self._pending)][live])
+
+            ids = ids[live]
+
+        if len(ids):
+
+            found = min(k, len(ids))
+
+            distances[:, :found], rows = faiss.knn(queries, vectors, found, metric=self.METRICS[self.metric])
+
+            labels[:, :found] = ids[rows]
+
+        return distances, labels
+
+    
+
+    def save(self, filepath: str):
+
+        """Save FAISS index to disk
+
+        
+
+        An index still too small to train is saved as a flat index of its
+
+        held-back vectors, with its settings in filepath.pending.json.
+
+        """
+
+        self.build()
+
+        pending_path = f"{filepath}.pending.json"
+
+        index = self.index
+
+        if index is None:
+
+            index = faiss.IndexIDMap(faiss.IndexFlat(self.dimension, self.METRICS[self.metric]))
+
+            if self._pending is not None:
+
+                for embeddings, ids in self._pending.blocks(self.add_block_size):
+
+                    index.add_with_ids(embeddings, ids)
+
+        # faiss writes by filename, so sync and rename its output by hand
+
+        tmp_path = f"{filepath}.tmp"
+
+        faiss.write_index(index, tmp_path)
+
+        with open(tmp_path, "rb+") as f:
+
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, filepath)
+
+        if self.index is None:
+
+            settings = {"index_type": self.index_type, "nlist": self.nlist, "pq_m": self.pq_m,
+
+                        "reduce_dim": self.reduce_dim, "transform": self.transform}
+
+            with atomic_write(pending_path, "w") as f:
+
+                json.dump(settings, f)
+
+        elif os.path.exists(pending_path):
+
+            os.remove(pending_path)
+
+        
+
+    def load(self, filepath: str, mmap: bool = False):
+
+        """Load FAISS index from disk
+
+        
+
+        mmap=True maps the file instead of reading it: cold start is nearly
+
+        instant, processes share the pages, and the index is read-only.
+
+        """
+
+        if mmap:
+
+            try:
+
+                # IO_FLAG_MMAP_IFC maps flat codes (Flat, HNSW storage); FAISS >= 1.8
+
+                self.index = faiss.read_index(
+
+                    filepath, faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0))
+
+            except RuntimeError:
+
+                # IVF inverted lists only map through the plain file reader
+
+                self.index = faiss.read_index(filepath, faiss.IO_FLAG_MMAP)
+
+        else:
+
+            self.index = faiss.read_index(filepath)
+
+        self.metric = "ip" if self.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+        self._pending = None
+
+        self._sample = None
+
+        self._seen = 0
+
+        
+
+        pending_path = f"{filepath}.pending.json"
+
+        if os.path.exists(pending_path) or not self.index.is_trained:
+
+            # Saved before training: hold its vectors back again until build()
+
+            stored = self.index
+
+            if os.path.exists(pending_path):
+
+                with open(pending_path, "r") as f:
+
+                    settings = json.load(f)
+
+                for name in ("index_type", "nlist", "pq_m", "reduce_dim", "transform"):
+
+                    setattr(self, name, settings[name])
+
+            self.index = None
+
+            self._next_id = 0
+
+            if stored.ntotal:
+
+                self.add_documents(stored.index.reconstruct_n(0, stored.ntotal),
+
+                                   faiss.vector_to_array(stored.id_map))
+
+            return
+
+        base = self._base_index()
+
+        self.reduce_dim = base.d if base.d != self.index.d else None
+
+        self._next_id = self.index.ntotal
+
+        if isinstance(self.index, faiss.IndexIDMap) and self.index.ntotal:
+
+            self._next_id = int(faiss.vector_to_array(self.index.id_map).max()) + 1
+
+        ivf = faiss.try_extract_index_ivf(self.index)
+
+        if ivf is not None and ivf.ntotal:
+
+            # IVF keeps its ids in the inverted lists
+
+            invlists = ivf.invlists
+
+            self._next_id = 1 + max(
+
+                int(faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).max())
+
+                for i in range(ivf.nlist) if invlists.list_size(i))
+
+
+
+class ShardedFAISSIndex:
+
+    """FAISSIndex partitioned by id over several shards, with the same interface
+
+    
+
+    Vector id i lives in shard i % num_shards. Adds, builds and searches run
+
+    on all shards at once on a thread pool (FAISS releases the GIL), and the
+
+    per-shard top-k lists are merged with a heap. save() writes every shard
+
+    to its own file (index-0.faiss, index-1.faiss, ... for index.faiss), so
+
+    a shard can be rebuilt and saved on its own with save_shard().
+
+    """
+
+    
+
+    def __init__(self, num_shards: int, dimension: int, index_type: str = "L2",
+
+                 buffer_path: Optional[str] = None, **index_options):
+
+        """index_type and index_options are handed to every shard's
+
+        FAISSIndex; shard i buffers at buffer_path-i if a path is given."""
+
+        if num_shards < 1:
+
+            raise ValueError(f"num_shards must be at least 1, got {num_shards}")
+
+        self.dimension = dimension
+
+        self.index_type = index_type
+
+        self._options = dict(index_options)
+
+        self._buffer_path = buffer_path
+
+        self.shards = [self._new_shard(i) for i in range(num_shards)]
+
+        self.metric = self.shards[0].metric
+
+        self._next_id = 0
+
+        self._pool = ThreadPoolExecutor(max_workers=num_shards, thread_name_prefix="faiss-shard")
+
+        
+
+    def _new_shard(self, i: int) -> FAISSIndex:
+
+        buffer_path = f"{self._buffer_path}-{i}" if self._buffer_path else None
+
+        return FAISSIndex(self.dimension, self.index_type, buffer_path=buffer_path, **self._options)
+
+    
+
+    @property
+
+    def num_shards(self) -> int:
+
+        return len(self.shards)
+
+    
+
+    def _each(self, fn, *args) -> list:
+
+        """fn(shard, *per-shard args) for every shard, in parallel"""
+
+        return list(self._pool.map(fn, self.shards, *args))
+
+    
+
+    def _partition(self, ids: np.ndarray) -> List[np.ndarray]:
+
+        owner = ids % self.num_shards
+
+        return [owner == i for i in range(self.num_shards)]
+
+    
+
+    def add_documents(self, embeddings: np.ndarray, ids: Optional[np.ndarray] = None):
+
+        """Add document embeddings under ids (default: the next unused ids)"""
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+
+        if ids is None:
+
+            ids = np.arange(self._next_id, self._next_id + len(embeddings))
+
+        ids = np.asarray(ids, dtype=np.int64)
+
+        if len(ids):
+
+            self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+        
+
+        def add(shard: FAISSIndex, part: np.ndarray):
+
+            if part.any():
+
+                shard.add_documents(embeddings[part], ids[part])
+
+        self._each(add, self._partition(ids))
+
+        
+
+    def remove_ids(self, ids: Iterable[int]) -> int:
+
+        """Remove vectors by id; returns how many were actually removed"""
+
+        ids = np.asarray(list(ids), dtype=np.int64)
+
+        return sum(self._each(lambda shard, part: shard.remove_ids(ids[part]) if part.any() else 0,
+
+                              self._partition(ids)))
+
+    
+
+    def bytes_per_vector(self) -> int:
+
+        return self.shards[0].bytes_per_vector()
+
+    
+
+    def defer(self, enabled: bool = True):
+
+        self._each(lambda shard: shard.defer(enabled))
+
+        
+
+    def build(self):
+
+        self._each(lambda shard: shard.build())
+
+        
+
+    def flush(self):
+
+        self._each(lambda shard: shard.flush())
+
+        
+
+    def search(self, query_embedding: np.ndarray, k: int = 5) -> tuple:
+
+        """Search for similar documents"""
+
+        distances, indices = self.search_many(query_embedding.reshape(1, -1), k)
+
+        return distances[0], indices[0]
+
+    
+
+    def search_many(self, query_embeddings: np.ndarray, k: int = 5,
+
+                    nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+
+                    id_mask: Optional[np.ndarray] = None) -> tuple:
+
+        """Search every shard for the top k and merge; see FAISSIndex.search_many"""
+
+        results = self._each(lambda shard: shard.search_many(query_embeddings, k, nprobe, ef_search, id_mask))
+
+        
+
+        # Each shard's hits are already sorted, best first (padding last)
+
+        distances = np.empty((len(query_embeddings), k), dtype=np.float32)
+
+        indices = np.empty((len(query_embeddings), k), dtype=np.int64)
+
+        for row in range(len(query_embeddings)):
+
+            merged = heapq.merge(*(zip(shard_distances[row], shard_indices[row])
+
+                                   for shard_distances, shard_indices in results),
+
+                                 key=lambda hit: hit[0], reverse=self.metric == "ip")
+
+            distances[row], indices[row] = zip(*itertools.islice(merged, k))
+
+        return distances, indices
+
+    
+
+    @staticmethod
+
+    def shard_path(filepath: str, i: int) -> str:
+
+        root, ext = os.path.splitext(filepath)
+
+        return f"{root}-{i}{ext}"
+
+    
+
+    def save(self, filepath: str):
+
+        """Save every shard next to filepath"""
+
+        self._each(lambda shard, i: self.save_shard(i, filepath), range(self.num_shards))
+
+        
+
+    def save_shard(self, i: int, filepath: str):
+
+        shard = self.shards[i]
+
+        path = self.shard_path(filepath, i)
+
+        shard.build()
+
+        if shard.index is None:
+
+            # Nothing was ever added here; drop any file left by an earlier save
+
+            if os.path.exists(path):
+
+                os.remove(path)
+
+            return
+
+        shard.save(path)
+
+        
+
+    def load(self, filepath: str, mmap: bool = False):
+
+        """Load shards saved next to filepath; shards without a file start empty"""
+
+        if os.path.exists(self.shard_path(filepath, self.num_shards)):
+
+            raise ValueError(f"{filepath} was saved with more than {self.num_shards} shards")
+
+        found = [os.path.exists(self.shard_path(filepath, i)) for i in range(self.num_shards)]
+
+        if not any(found) and os.path.exists(filepath):
+
+            raise ValueError(f"{filepath} is an unsharded index; load it with FAISSIndex")
+
+        
+
+        def load(shard: FAISSIndex, i: int) -> FAISSIndex:
+
+            path = self.shard_path(filepath, i)
+
+            if not os.path.exists(path):
+
+                return self._new_shard(i)
+
+            shard.load(path, mmap=mmap)
+
+            return shard
+
+        self.shards = self._each(load, range(self.num_shards))
+
+        self.metric = self.shards[0].metric
+
+        self._next_id = max(shard._next_id for shard in self.shards)
+
+        
+
+class BM25Index:
+
+    """Okapi BM25 over chunk ids, with array-backed postings
+
+    
+
+    Each term keeps the ids of the chunks containing it and its frequency in
+
+    each, in two typed arrays appended to as chunks arrive. A query is
+
+    scored with a few vectorized passes over the postings of its terms.
+
+    save() writes the postings in CSR form: concatenated ids and
+
+    frequencies plus one offsets array.
+
+    """
+
+    
+
+    # Words, and identifiers that join them with - . / : (ACC-1042, BRK.B)
+
+    _TOKEN = re.compile(r"\w+(?:[-./:]\w+)*")
+
+    
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+
+        self.k1 = k1
+
+        self.b = b
+
+        self.postings: Dict[str, Tuple[array, array]] = {}
+
+        # Token count per chunk id; 0 for removed (or never added) ids
+
+        self.doc_lens = array("I")
+
+        self.num_docs = 0
+
+        self.total_len = 0
+
+        
+
+    @classmethod
+
+    def tokenize(cls, text: str) -> List[str]:
+
+        """Lowercased terms; identifiers also yield their parts"""
+
+        terms = []
+
+        for match in cls._TOKEN.finditer(text.lower()):
+
+            term = match.group()
+
+            terms.append(term)
+
+            parts = re.findall(r"\w+", term)
+
+            if len(parts) > 1:
+
+                terms.extend(parts)
+
+        return terms
+
+    
+
+    def add(self, chunk_ids: Iterable[int], texts: Iterable[str]):
+
+        for chunk_id, text in zip(chunk_ids, texts):
+
+            terms = self.tokenize(text)
+
+            if not terms:
+
+                continue
+
+            if chunk_id >= len(self.doc_lens):
+
+                self.doc_lens.extend([0] * (chunk_id + 1 - len(self.doc_lens)))
+
+            self.doc_lens[chunk_id] = len(terms)
+
+            self.num_docs += 1
+
+            self.total_len += len(terms)
+
+            
+
+            for term, tf in Counter(terms).items():
+
+                posting = self.postings.get(term)
+
+                if posting is None:
+
+                    posting = self.postings[term] = (array("q"), array("I"))
+
+                posting[0].append(chunk_id)
+
+                posting[1].append(tf)
+
+                
+
+    def remove(self, chunk_ids: Iterable[int]):
+
+        """Stop matching these chunks; their postings go at compact()"""
+
+        for chunk_id in chunk_ids:
+
+            if chunk_id < len(self.doc_lens) and self.doc_lens[chunk_id]:
+
+                self.num_docs -= 1
+
+                self.total_len -= self.doc_lens[chunk_id]
+
+                self.doc_lens[chunk_id] = 0
+
+                
+
+    def compact(self):
+
+        """Drop postings of removed chunks"""
+
+        doc_lens = np.frombuffer(self.doc_lens, dtype=np.uint32)
+
+        for term, (ids, tfs) in list(self.postings.items()):
+
+            chunk_ids = np.frombuffer(ids, dtype=np.int64)
+
+            live = doc_lens[chunk_ids] > 0
+
+            if live.all():
+
+                continue
+
+            if not live.any():
+
+                del self.postings[term]
+
+                continue
+
+            self.postings[term] = (array("q", chunk_ids[live].tobytes()),
+
+                                   array("I", np.frombuffer(tfs, dtype=np.uint32)[live].tobytes()))
+
+        
+
+    def search(self, query: str, k: int = 5,
+
+               id_mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+
+        """Top k (scores, chunk ids) for query, best first; may be fewer than k
+
+        
+
+        id_mask, a boolean array covering every chunk id, skips the chunks
+
+        it leaves unset.
+
+        """
+
+        scores, ids = [], []
+
+        if self.num_docs:
+
+            doc_lens = np.frombuffer(self.doc_lens, dtype=np.uint32)
+
+            avgdl = self.total_len / self.num_docs
+
+            for term in set(self.tokenize(query)):
+
+                posting = self.postings.get(term)
+
+                if posting is None:
+
+                    continue
+
+                chunk_ids = np.frombuffer(posting[0], dtype=np.int64)
+
+                lens = doc_lens[chunk_ids]
+
+                live = lens > 0
+
+                # Document frequency over every live chunk, so a filter
+
+                # narrows the candidates without reweighting the terms
+
+                df = np.count_nonzero(live)
+
+                idf = np.log1p((self.num_docs - df + 0.5) / (df + 0.5))
+
+                if id_mask is not None:
+
+                    live &= id_mask[chunk_ids]
+
+                chunk_ids, lens = chunk_ids[live], lens[live]
+
+                tfs = np.frombuffer(posting[1], dtype=np.uint32)[live].astype(np.float32)
+
+                
+
+                norm = self.k1 * (1 - self.b + self.b * lens / avgdl)
+
+                scores.append(idf * tfs * (self.k1 + 1) / (tfs + norm))
+
+                ids.append(chunk_ids)
+
+                
+
+        if not ids:
+
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        
+
+        # Sum per chunk over the query terms
+
+        ids, inverse = np.unique(np.concatenate(ids), return_inverse=True)
+
+        scores = np.bincount(inverse, weights=np.concatenate(scores))
+
+        top = np.argpartition(-scores, k - 1)[:k] if len(scores) > k else np.arange(len(scores))
+
+        top = top[np.argsort(-scores[top], kind="stable")]
+
+        return scores[top].astype(np.float32), ids[top]
+
+    
+
+    def save(self, filepath: str):
+
+        terms = list(self.postings)
+
+        lengths = np.fromiter((len(self.postings[term][0]) for term in terms), dtype=np.int64,
+
+                              count=len(terms))
+
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+
+        np.cumsum(lengths, out=offsets[1:])
+
+        with atomic_write(filepath) as f:
+
+            np.savez(f,
+
+                     terms=np.frombuffer("\n".join(terms).encode(), dtype=np.uint8),
+
+                     offsets=offsets,
+
+                     ids=np.frombuffer(b"".join(self.postings[t][0].tobytes() for t in terms), dtype=np.int64),
+
+                     tfs=np.frombuffer(b"".join(self.postings[t][1].tobytes() for t in terms), dtype=np.uint32),
+
+                     doc_lens=np.frombuffer(self.doc_lens, dtype=np.uint32),
+
+                     params=np.array([self.k1, self.b]))
+
+            
+
+    def load(self, filepath: str):
+
+        with np.load(filepath) as data:
+
+            terms = data["terms"].tobytes().decode().split("\n") if data["terms"].size else []
+
+            offsets, ids, tfs = data["offsets"], data["ids"], data["tfs"]
+
+            self.doc_lens = array("I", data["doc_lens"].tobytes())
+
+            self.k1, self.b = (float(x) for x in data["params"])
+
+            
+
+        self.postings = {
+
+            term: (array("q", ids[start:stop].tobytes()), array("I", tfs[start:stop].tobytes()))
+
+            for term, start, stop in zip(terms, offsets[:-1], offsets[1:])
+
+        }
+
+        doc_lens = np.frombuffer(self.doc_lens, dtype=np.uint32)
+
+        self.num_docs = int(np.count_nonzero(doc_lens))
+
+        self.total_len = int(doc_lens.sum())
+
+
+
+class MetadataIndex:
+
+    """Chunk ids per (field, value) of document metadata, for filtered search
+
+    
+
+    Filters are dicts of field -> condition, all of which must hold:
+
+    
+
+        {"tenant": "acme", "year": {"$gte": 2023}, "source": ["wiki", "faq"]}
+
+    
+
+    A plain value tests equality and a list membership; a dict combines
+
+    operators from OPERATORS. Chunks without the field never match. Only
+
+    scalar metadata values (str, int, float, bool) are indexed; doc_id is
+
+    indexed like any other field.
+
+    """
+
+    
+
+    OPERATORS = {
+
+        "$eq": lambda value, operand: value == operand,
+
+        "$ne": lambda value, operand: value != operand,
+
+        "$in": lambda value, operand: value in operand,
+
+        "$nin": lambda value, operand: value not in operand,
+
+        "$gt": lambda value, operand: value > operand,
+
+        "$gte": lambda value, operand: value >= operand,
+
+        "$lt": lambda value, operand: value < operand,
+
+        "$lte": lambda value, operand: value <= operand,
+
+    }
+
+    RANGE_OPERATORS = ("$gt", "$gte", "$lt", "$lte")
+
+    
+
+    def __init__(self):
+
+        # field -> value -> sorted chunk ids
+
+        self.postings: Dict[str, Dict[Any, array]] = {}
+
+        # field -> str or float -> that field's values of the kind, sorted; built on demand
+
+        self._ordered: Dict[str, Dict[type, list]] = {}
+
+        
+
+    def add(self, chunk_ids: Iterable[int], metadata: Dict[str, Any]):
+
+        chunk_ids = list(chunk_ids)
+
+        for field, value in metadata.items():
+
+            if not isinstance(value, (str, int, float, bool)):
+
+                continue
+
+            values = self.postings.setdefault(field, {})
+
+            posting = values.get(value)
+
+            if posting is None:
+
+                posting = values[value] = array("q")
+
+                self._ordered.pop(field, None)
+
+            posting.extend(chunk_ids)
+
+            
+
+    def mask(self, where: Dict[str, Any], size: int) -> np.ndarray:
+
+        """Boolean array over chunk ids 0..size-1, True where where holds"""
+
+        mask = np.ones(size, dtype=bool)
+
+        for field, condition in where.items():
+
+            if not isinstance(condition, dict):
+
+                condition = {"$in" if isinstance(condition, (list, tuple, set)) else "$eq": condition}
+
+            for op in condition:
+
+                if op not in self.OPERATORS:
+
+                    raise ValueError(f"Unknown filter operator {op!r}; expected one of {tuple(self.OPERATORS)}")
+
+                
+
+            field_mask = np.zeros(size, dtype=bool)
+
+            for posting in self._matching(field, condition):
+
+                field_mask[np.frombuffer(posting, dtype=np.int64)] = True
+
+            mask &= field_mask
+
+        return mask
+
+    
+
+    def _matching(self, field: str, condition: Dict[str, Any]) -> Iterator[array]:
+
+        """Postings of the field values that satisfy every operator in condition"""
+
+        values = self.postings.get(field, {})
+
+        op, operand = next(iter(condition.items())) if len(condition) == 1 else (None, None)
+
+        if op == "$eq" or (op == "$in" and isinstance(operand, (list, tuple, set))):
+
+            # Equality is a dict lookup, however many values the field has
+
+            for value in ([operand] if op == "$eq" else operand):
+
+                try:
+
+                    posting = values.get(value)
+
+                except TypeError:
+
+                    # Unhashable, so equal to no indexed scalar
+
+                    continue
+
+                if posting is not None:
+
+                    yield posting
+
+            return
+
+        rest = condition.items()
+
+        candidates = self._in_range(field, condition)
+
+        if candidates is None:
+
+            candidates = values
+
+        else:
+
+            rest = [(op, operand) for op, operand in rest if op not in self.RANGE_OPERATORS]
+
+        for value in candidates:
+
+            if all(self._test(op, value, operand) for op, operand in rest):
+
+                yield values[value]
+
+                
+
+    def _in_range(self, field: str, condition: Dict[str, Any]) -> Optional[list]:
+
+        """The field values within condition's range operators, found by bisecting
+
+        the sorted values; None when there are none to bisect on"""
+
+        bounds = [(op, operand) for op, operand in condition.items() if op in self.RANGE_OPERATORS]
+
+        kinds = {self._kind(operand) for _, operand in bounds}
+
+        if not bounds or len(kinds) != 1 or None in kinds or any(operand != operand for _, operand in bounds):
+
+            return None
+
+        kind = kinds.pop()
+
+        ordered = self._ordered.setdefault(field, {})
+
+        if kind not in ordered:
+
+            # NaN compares false with everything, so no range holds it
+
+            ordered[kind] = sorted(value for value in self.postings.get(field, {})
+
+                                   if self._kind(value) is kind and value == value)
+
+        keys = ordered[kind]
+
+        lo, hi = 0, len(keys)
+
+        for op, operand in bounds:
+
+            if op == "$gt":
+
+                lo = max(lo, bisect_right(keys, operand))
+
+            elif op == "$gte":
+
+                lo = max(lo, bisect_left(keys, operand))
+
+            elif op == "$lt":
+
+                hi = min(hi, bisect_left(keys, operand))
+
+            else:
+
+                hi = min(hi, bisect_right(keys, operand))
+
+        return keys[lo:hi]
+
+    
+
+    @staticmethod
+
+    def _kind(value: Any) -> Optional[type]:
+
+        """str or float (any number), the groups of values that order together"""
+
+        if isinstance(value, str):
+
+            return str
+
+        if isinstance(value, (int, float)):
+
+            return float
+
+        return None
+
+    
+
+    def _test(self, op: str, value: Any, operand: Any) -> bool:
+
+        try:
+
+            return self.OPERATORS[op](value, operand)
+
+        except TypeError:
+
+            # Mixed types, e.g. a range over a field holding some strings
+
+            return False
+
+        
+
+    def compact(self, removed: Iterable[int]):
+
+        """Drop these chunk ids from every posting"""
+
+        removed = np.fromiter(removed, dtype=np.int64)
+
+        for values in self.postings.values():
+
+            for value, posting in list(values.items()):
+
+                chunk_ids = np.frombuffer(posting, dtype=np.int64)
+
+                live = chunk_ids[~np.isin(chunk_ids, removed)]
+
+                if not len(live):
+
+                    del values[value]
+
+                    self._ordered.clear()
+
+                elif len(live) < len(chunk_ids):
+
+                    values[value] = array("q", live.tobytes())
+
+        
+
+    def save(self, filepath: str):
+
+        keys = [(field, value) for field, values in self.postings.items() for value in values]
+
+        lengths = np.fromiter((len(self.postings[field][value]) for field, value in keys), dtype=np.int64,
+
+                              count=len(keys))
+
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+
+        np.cumsum(lengths, out=offsets[1:])
+
+        with atomic_write(filepath) as f:
+
+            np.savez(f,
+
+                     keys=np.frombuffer(json.dumps(keys).encode(), dtype=np.uint8),
+
+                     offsets=offsets,
+
+                     ids=np.frombuffer(b"".join(self.postings[field][value].tobytes()
+
+                                                for field, value in keys), dtype=np.int64))
+
+            
+
+    def load(self, filepath: str):
+
+        with np.load(filepath) as data:
+
+            keys = json.loads(data["keys"].tobytes())
+
+            offsets, ids = data["offsets"], data["ids"]
+
+        self.postings = {}
+
+        self._ordered = {}
+
+        for (field, value), start, stop in zip(keys, offsets[:-1], offsets[1:]):
+
+            self.postings.setdefault(field, {})[value] = array("q", ids[start:stop].tobytes())
+
+
+
+class QueryCache:
+
+    """In-memory LRU cache with an optional time-to-live
+
+    
+
+    Holds at most max_entries values; an entry older than ttl seconds is
+
+    treated as missing. max_entries=0 disables caching.
+
+    """
+
+    
+
+    def __init__(self, max_entries: int = 10_000, ttl: Optional[float] = None):
+
+        self.max_entries = max_entries
+
+        self.ttl = ttl
+
+        self.hits = 0
+
+        self.misses = 0
+
+        self._entries: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+
+        self._lock = threading.Lock()
+
+        
+
+    def get(self, key: Any) -> Any:
+
+        """The cached value for key, or None"""
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+
+                del self._entries[key]
+
+                entry = None
+
+            if entry is None:
+
+                self.misses += 1
+
+                return None
+
+            self._entries.move_to_end(key)
+
+            self.hits += 1
+
+            return entry[1]
+
+        
+
+    def put(self, key: Any, value: Any):
+
+        if self.max_entries <= 0:
+
+            return
+
+        with self._lock:
+
+            self._entries[key] = (time.monotonic(), value)
+
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+
+                self._entries.popitem(last=False)
+
+                
+
+    def clear(self):
+
+        with self._lock:
+
+            self._entries.clear()
+
+            
+
+    @property
+
+    def hit_rate(self) -> float:
+
+        lookups = self.hits + self.misses
+
+        return self.hits / lookups if lookups else 0.0
+
+    
+
+    def __len__(self) -> int:
+
+        return len(self._entries)
+
+
+
+class NearDuplicateFilter:
+
+    """MinHash signatures and LSH banding to recognize near-duplicate chunks
+
+    
+
+    A chunk is reduced to its shingles (runs of shingle_size words), and
+
+    num_perm universal hash functions keep the minimum hash over them.
+
+    Signatures are split into bands; a chunk sharing any whole band with a
+
+    registered one is a candidate, and a duplicate once the share of equal
+
+    signature entries (an estimate of the shingles' Jaccard similarity)
+
+    reaches threshold. The default threshold leaves room for the overlap
+
+    that chunking carries into otherwise identical boilerplate.
+
+    """
+
+    
+
+    # Smallest prime above 2**32, the modulus of the hash family
+
+    _PRIME = 4294967311
+
+    
+
+    def __init__(self, num_perm: int = 128, bands: int = 32, shingle_size: int = 5,
+
+                 threshold: float = 0.7, seed: int = 0):
+
+        if num_perm % bands:
+
+            raise ValueError(f"bands ({bands}) must divide num_perm ({num_perm})")
+
+        self.num_perm = num_perm
+
+        self.bands = bands
+
+        self.shingle_size = shingle_size
+
+        self.threshold = threshold
+
+        self.seed = seed
+
+        
+
+        # a, b < 2**32 so a * x + b stays within uint64 for 32-bit x
+
+        rng = np.random.default_rng(seed)
+
+        self._a = rng.integers(1, 2**32, num_perm, dtype=np.uint64)[:, None]
+
+        self._b = rng.integers(0, 2**32, num_perm, dtype=np.uint64)[:, None]
+
+        self.signatures: Dict[int, np.ndarray] = {}
+
+        # One dict per band: band bytes -> chunk ids registered under it
+
+        self._buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+
+        
+
+    def signature(self, text: str) -> np.ndarray:
+
+        words = re.findall(r"\w+", text.lower())
+
+        grams = max(1, len(words) - self.shingle_size + 1)
+
+        shingles = {zlib.crc32(" ".join(words[i:i + self.shingle_size]).encode("utf-8"))
+
+                    for i in range(grams)}
+
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles))[None, :]
+
+        hashes = ((self._a * x + self._b) % np.uint64(self._PRIME)).min(axis=1)
+
+        return np.minimum(hashes, 2**32 - 1).astype(np.uint32)
+
+    
+
+    def _bands(self, signature: np.ndarray) -> Iterator[Tuple[Dict[bytes, List[int]], bytes]]:
+
+        rows = self.num_perm // self.bands
+
+        for band, bucket in enumerate(self._buckets):
+
+            yield bucket, signature[band * rows:(band + 1) * rows].tobytes()
+
+            
+
+    def find(self, signature: np.ndarray) -> Optional[int]:
+
+        """The registered chunk signature near-duplicates, or None"""
+
+        for bucket, key in self._bands(signature):
+
+            for chunk_id in bucket.get(key, ()):
+
+                if np.mean(self.signatures[chunk_id] == signature) >= self.threshold:
+
+                    return chunk_id
+
+        return None
+
+    
+
+    def add(self, chunk_id: int, signature: np.ndarray):
+
+        self.signatures[chunk_id] = signature
+
+        for bucket, key in self._bands(signature):
+
+            bucket.setdefault(key, []).append(chunk_id)
+
+            
+
+    def remove(self, chunk_ids: Iterable[int]):
+
+        for chunk_id in chunk_ids:
+
+            signature = self.signatures.pop(chunk_id, None)
+
+            if signature is None:
+
+                continue
+
+            for bucket, key in self._bands(signature):
+
+                bucket[key].remove(chunk_id)
+
+                if not bucket[key]:
+
+                    del bucket[key]
+
+                    
+
+    def save(self, filepath: str):
+
+        ids = np.fromiter(self.signatures, dtype=np.int64, count=len(self.signatures))
+
+        signatures = (np.stack(list(self.signatures.values())) if self.signatures
+
+                      else np.empty((0, self.num_perm), dtype=np.uint32))
+
+        with atomic_write(filepath) as f:
+
+            np.savez(f, ids=ids, signatures=signatures,
+
+                     params=np.array([self.num_perm, self.bands, self.shingle_size, self.seed]),
+
+                     threshold=np.array(self.threshold))
+
+            
+
+    def load(self, filepath: str):
+
+        with np.load(filepath) as data:
+
+            num_perm, bands, shingle_size, seed = (int(x) for x in data["params"])
+
+            self.__init__(num_perm, bands, shingle_size, float(data["threshold"]), seed)
+
+            for chunk_id, signature in zip(data["ids"].tolist(), data["signatures"]):
+
+                self.add(chunk_id, signature)
+
+
+
+class SearchCoalescer:
+
+    """Batches concurrent RAGSystem searches made from one asyncio event loop
+
+    
+
+    While no batch is running a query is dispatched on the next loop
+
+    iteration, together with any submitted alongside it, so a lone query
+
+    waits for nothing. While batches are running, queries queue for up to
+
+    max_wait seconds or until max_batch of them are waiting. A batch goes
+
+    to search_many on a worker thread, one call per distinct set of search
+
+    options, and each caller's future gets its own result list.
+
+    """
+
+    
+
+    def __init__(self, rag: "RAGSystem", max_wait: float = 0.005, max_batch: int = 64):
+
+        self.rag = rag
+
+        self.max_wait = max_wait
+
+        self.max_batch = max_batch
+
+        self.loop = asyncio.get_running_loop()
+
+        self.stats = {"queries": 0, "batches": 0}
+
+        self._pending: List[Tuple[str, Dict[str, Any], asyncio.Future]] = []
+
+        self._handle: Optional[asyncio.Handle] = None
+
+        self._running = 0
+
+        
+
+    def submit(self, query: str, **options) -> asyncio.Future:
+
+        """Queue query; options are the keyword arguments of search_many"""
+
+        future = self.loop.create_future()
+
+        self._pending.append((query, options, future))
+
+        if len(self._pending) >= self.max_batch:
+
+            self._flush()
+
+        elif self._handle is None:
+
+            if self._running:
+
+                self._handle = self.loop.call_later(self.max_wait, self._flush)
+
+            else:
+
+                self._handle = self.loop.call_soon(self._flush)
+
+        return future
+
+    
+
+    def _flush(self):
+
+        if self._handle is not None:
+
+            self._handle.cancel()
+
+            self._handle = None
+
+        batch, self._pending = self._pending, []
+
+        
+
+        groups: Dict[str, list] = {}
+
+        for item in batch:
+
+            key = json.dumps(item[1], sort_keys=True, default=repr)
+
+            groups.setdefault(key, []).append(item)
+
+        for items in groups.values():
+
+            self._running += 1
+
+            self.loop.create_task(self._run(items))
+
+            
+
+    async def _run(self, items: List[Tuple[str, Dict[str, Any], asyncio.Future]]):
+
+        queries = [query for query, _, _ in items]
+
+        self.stats["queries"] += len(queries)
+
+        self.stats["batches"] += 1
+
+        try:
+
+            results = await self.loop.run_in_executor(
+
+                None, functools.partial(self.rag.search_many, queries, **items[0][1]))
+
+        except Exception as e:
+
+            for _, _, future in items:
+
+                if not future.done():
+
+                    future.set_exception(e)
+
+        else:
+
+            for (_, _, future), result in zip(items, results):
+
+                if not future.done():
+
+                    future.set_result(result)
+
+        finally:
+
+            self._running -= 1
+
+            if self._pending and self._handle is None:
+
+                self._flush()
+
+
+
+class RAGSystem:
+
+    SEARCH_MODES = ("dense", "lexical", "hybrid")
+
+    DEDUP_MODES = ("drop", "alias")
+
+    # Reciprocal rank fusion: constant in 1 / (RRF_K + rank), and how many
+
+    # hits each side contributes
+
+    RRF_K = 60
+
+    RRF_DEPTH = 50
+
+    # asearch batching: longest wait for company while busy, largest batch
+
+    COALESCE_WAIT = 0.005
+
+    COALESCE_BATCH = 64
+
+    
+
+    def __init__(self, chunker: HybridChunker, encoder: HybridEncoder, 
+
+                 dimension: int = 768, compact: bool = False, index_type: str = "L2",
+
+                 lexical: bool = True, cache_size: int = 10_000, cache_ttl: Optional[float] = 3600.0,
+
+                 shards: int = 1, dedup: Optional[str] = None, **index_options):
+
+        """compact: keep chunks in a ChunkStore. shards > 1: use a ShardedFAISSIndex.
+
+        index_type and index_options are handed to FAISSIndex.
+
+        lexical: also keep a BM25 index; search() then defaults to hybrid mode.
+
+        cache_size/cache_ttl: query caches (0 disables). dedup: "drop" or "alias".
+
+        """
+
+        if dedup is not None and dedup not in self.DEDUP_MODES:
+
+            raise ValueError(f"Unknown dedup mode {dedup!r}; expected one of {self.DEDUP_MODES}")
+
+        self.chunker = chunker
+
+        self.encoder = encoder
+
+        if shards > 1:
+
+            self.index = ShardedFAISSIndex(shards, dimension, index_type, **index_options)
+
+        else:
+
+            self.index = FAISSIndex(dimension, index_type, **index_options)
+
+        self.lexical = BM25Index() if lexical else None
+
+        self.filters = MetadataIndex()
+
+        self.query_cache = QueryCache(cache_size, cache_ttl)
+
+        self.result_cache = QueryCache(cache_size, cache_ttl)
+
+        self._compact = compact
+
+        self.documents = ChunkStore() if compact else []
+
+        # Set by load(mmap=True): the mapped index and store cannot change
+
+        self.read_only = False
+
+        
+
+        # Every chunk gets a never-reused id, which is also its FAISS id;
+
+        # chunk_ids[row] is the id of documents[row] and stays sorted
+
+        self.chunk_ids = array("q")
+
+        self.next_chunk_id = 0
+
+        # Document id -> the contiguous range of its chunk ids
+
+        self.doc_chunks: Dict[str, range] = {}
+
+        # Chunk ids deleted but still in documents, until compact()
+
+        self.deleted = set()
+
+        # How many deleted ids the FAISS index could not drop (HNSW)
+
+        self._stale = 0
+
+        # Chunk ids registered but not yet added to the FAISS index
+
+        self._unindexed = set()
+
+        
+
+        self.dedup_mode = dedup
+
+        self.dedup = NearDuplicateFilter() if dedup else None
+
+        # Near-duplicate chunk id -> the chunk whose vector stands for it
+
+        self.duplicates: Dict[int, int] = {}
+
+        # For dedup="alias": chunk id -> its aliased duplicates
+
+        self._aliases: Dict[int, List[int]] = {}
+
+        self._dedup_counts = {"chunks": 0, "duplicates": 0}
+
+        
+
+        self.coalescer: Optional[SearchCoalescer] = None
+
+        # Serializes FAISS adds and removals while ingest() adds from a thread
+
+        self._index_lock = threading.Lock()
+
+        
+
+    def add_documents(self, texts: List[str], n_process: int = 1, batch_size: int = 64,
+
+                      encode_batch_size: int = 1024, doc_ids: Optional[Iterable[str]] = None,
+
+                      metadatas: Optional[Iterable[Dict[str, Any]]] = None):
+
+        """Process and index new documents
+
+        
+
+        doc_ids: stable ids; a known id replaces that document. metadatas: per-text
+
+        metadata, filterable with where= in search().
+
+        """
+
+        self._check_writable()
+
+        doc_ids = iter(doc_ids) if doc_ids is not None else None
+
+        metadatas = iter(metadatas) if metadatas is not None else None
+
+        pending: List[Document] = []
+
+        pending_ids: List[int] = []
+
+        texts, sources = itertools.tee(texts)
+
+        for text, chunks in zip(sources, self.chunker.chunk_many(texts, n_process=n_process,
+
+                                                                 batch_size=batch_size)):
+
+            doc_id = next(doc_ids) if doc_ids is not None else uuid.uuid4().hex
+
+            metadata = dict(next(metadatas) or {}) if metadatas is not None else {}
+
+            for chunk_id, chunk in self._register(text, chunks, doc_id, metadata):
+
+                pending.append(chunk)
+
+                pending_ids.append(chunk_id)
+
+            if len(pending) >= encode_batch_size:
+
+                self._index_chunks(pending, pending_ids)
+
+                pending, pending_ids = [], []
+
+                
+
+        if pending:
+
+            self._index_chunks(pending, pending_ids)
+
+            
+
+    def _check_writable(self):
+
+        """Refuse changes before any state is touched on a read-only system"""
+
+        if self.read_only:
+
+            raise ValueError("This RAGSystem was loaded with mmap=True and is read-only; "
+
+                             "load it without mmap to modify it")
+
+        
+
+    def _register(self, text: str, chunks: List[Document], doc_id: str,
+
+                  metadata: Dict[str, Any]) -> List[Tuple[int, Document]]:
+
+        """Give a new text's chunks ids and store them everywhere but FAISS;
+
+        returns the (chunk id, chunk) pairs still to be embedded"""
+
+        if doc_id in self.doc_chunks:
+
+            self.delete(doc_id)
+
+        
+
+        ids = range(self.next_chunk_id, self.next_chunk_id + len(chunks))
+
+        self.next_chunk_id = ids.stop
+
+        self.doc_chunks[doc_id] = ids
+
+        stored = embed = list(zip(ids, chunks))
+
+        if self.dedup is not None:
+
+            stored, embed = self._deduplicate(stored)
+
+        if not stored:
+
+            return []
+
+        stored_ids = [chunk_id for chunk_id, _ in stored]
+
+        stored_chunks = [chunk for _, chunk in stored]
+
+        
+
+        metadata["doc_id"] = doc_id
+
+        self._store_chunks(text, stored_chunks, metadata)
+
+        self.filters.add(stored_ids, metadata)
+
+        self.chunk_ids.extend(stored_ids)
+
+        if self.lexical is not None:
+
+            self.lexical.add(stored_ids, (chunk.text for chunk in stored_chunks))
+
+        self.result_cache.clear()
+
+        self._unindexed.update(chunk_id for chunk_id, _ in embed)
+
+        return embed
+
+    
+
+    def ingest(self, texts: Iterable[str], doc_ids: Optional[Iterable[str]] = None,
+
+               metadatas: Optional[Iterable[Dict[str, Any]]] = None, workers: Optional[int] = None,
+
+               chunk_batch: int = 64, encode_batch_size: int = 1024,
+
+               queue_size: int = 8) -> Dict[str, Dict[str, float]]:
+
+        """Pipelined add_documents: chunk, encode and index stages run at once
+
+        
+
+        Returns items, busy seconds and waiting seconds per stage.
+
+        """
+
+        self._check_writable()
+
+        workers = workers or os.cpu_count() or 1
+
+        texts = iter(texts)
+
+        doc_ids = iter(doc_ids) if doc_ids is not None else None
+
+        metadatas = iter(metadatas) if metadatas is not None else None
+
+        stats = {stage: {"items": 0, "seconds": 0.0, "waiting": 0.0} for stage in ("chunk", "encode", "index")}
+
+        chunked = queue.Queue(maxsize=queue_size)
+
+        encoded = queue.Queue(maxsize=queue_size)
+
+        stop = threading.Event()
+
+        errors = []
+
+        done = object()
+
+        
+
+        def chunk_stage():
+
+            try:
+
+                # spawn: forking a process that runs torch and threads is unsafe
+
+                with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+
+                                         initializer=_init_chunk_worker,
+
+                                         initargs=(self.chunker.config,)) as pool:
+
+                    inflight = deque()
+
+                    
+
+                    def drain(limit: int):
+
+                        while len(inflight) > limit:
+
+                            batch, future = inflight.popleft()
+
+                            chunks, elapsed = future.result()
+
+                            stats["chunk"]["items"] += len(batch)
+
+                            stats["chunk"]["seconds"] += elapsed
+
+                            start = time.perf_counter()
+
+                            chunked.put(list(zip(batch, chunks)))
+
+                            stats["chunk"]["waiting"] += time.perf_counter() - start
+
+                            
+
+                    while not stop.is_set():
+
+                        batch = list(itertools.islice(texts, chunk_batch))
+
+                        if not batch:
+
+                            drain(0)
+
+                            break
+
+                        inflight.append((batch, pool.submit(_chunk_worker, batch)))
+
+                        # Keep every worker busy, but no further ahead
+
+                        drain(2 * workers)
+
+            except BaseException as e:
+
+                chunked.put(e)
+
+            finally:
+
+                chunked.put(done)
+
+                
+
+        def index_stage():
+
+            while True:
+
+                start = time.perf_counter()
+
+                item = encoded.get()
+
+                stats["index"]["waiting"] += time.perf_counter() - start
+
+                if item is done:
+
+                    return
+
+                if errors:
+
+                    # Keep draining so the encode stage never blocks
+
+                    continue
+
+                embeddings, ids = item
+
+                start = time.perf_counter()
+
+                try:
+
+                    with self._index_lock:
+
+                        # Skip chunks whose document was replaced since encoding
+
+                        keep = np.fromiter((chunk_id in self._unindexed for chunk_id in ids.tolist()),
+
+                                           dtype=bool, count=len(ids))
+
+                        self.index.add_documents(embeddings[keep], ids[keep])
+
+                        self._unindexed.difference_update(ids.tolist())
+
+                except BaseException as e:
+
+                    errors.append(e)
+
+                stats["index"]["items"] += len(ids)
+
+                stats["index"]["seconds"] += time.perf_counter() - start
+
+                
+
+        def encode(chunks: List[Document], ids: List[int]):
+
+            chunks, ids = self._live_pending(chunks, ids)
+
+            if not ids:
+
+                return
+
+            start = time.perf_counter()
+
+            embeddings = self.encoder.encode_documents(chunks)
+
+            stats["encode"]["items"] += len(chunks)
+
+            stats["encode"]["seconds"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+
+            encoded.put((embeddings, np.asarray(ids, dtype=np.int64)))
+
+            stats["encode"]["waiting"] += time.perf_counter() - start
+
+            
+
+        started = time.perf_counter()
+
+        threads = [threading.Thread(target=chunk_stage, name="ingest-chunk", daemon=True),
+
+                   threading.Thread(target=index_stage, name="ingest-index", daemon=True)]
+
+        for thread in threads:
+
+            thread.start()
+
+        try:
+
+            pending: List[Document] = []
+
+            pending_ids: List[int] = []
+
+            while True:
+
+                start = time.perf_counter()
+
+                batch = chunked.get()
+
+                stats["encode"]["waiting"] += time.perf_counter() - start
+
+                if batch is done:
+
+                    break
+
+                if isinstance(batch, BaseException):
+
+                    raise batch
+
+                
+
+                for text, chunks in batch:
+
+                    doc_id = next(doc_ids) if doc_ids is not None else uuid.uuid4().hex
+
+                    metadata = dict(next(metadatas) or {}) if metadatas is not None else {}
+
+                    start = time.perf_counter()
+
+                    if doc_id in self.doc_chunks:
+
+                        # The index stage may be adding vectors right now
+
+                        with self._index_lock:
+
+                            self.delete(doc_id)
+
+                    for chunk_id, chunk in self._register(text, chunks, doc_id, metadata):
+
+                        pending.append(chunk)
+
+                        pending_ids.append(chunk_id)
+
+                    stats["encode"]["seconds"] += time.perf_counter() - start
+
+                    if len(pending) >= encode_batch_size:
+
+                        encode(pending, pending_ids)
+
+                        pending, pending_ids = [], []
+
+            if pending:
+
+                encode(pending, pending_ids)
+
+        except BaseException:
+
+            stop.set()
+
+            # Unblock the chunk stage so it can shut its pool down
+
+            while threads[0].is_alive() or not chunked.empty():
+
+                try:
+
+                    chunked.get(timeout=0.1)
+
+                except queue.Empty:
+
+                    pass
+
+            raise
+
+        finally:
+
+            encoded.put(done)
+
+            for thread in threads:
+
+                thread.join()
+
+        if errors:
+
+            raise errors[0]
+
+        self.result_cache.clear()
+
+        
+
+        elapsed = time.perf_counter() - started
+
+        for stage in stats.values():
+
+            stage["per_second"] = stage["items"] / stage["seconds"] if stage["seconds"] else 0.0
+
+        stats["total"] = {"items": stats["chunk"]["items"], "seconds": elapsed,
+
+                          "per_second": stats["chunk"]["items"] / elapsed if elapsed else 0.0}
+
+        logger.info("Ingested %d texts in %.1fs: %s", stats["chunk"]["items"], elapsed,
+
+                    ", ".join(f"{name} {stage['per_second']:,.0f}/s busy, {stage.get('waiting', 0.0):.1f}s waiting"
+
+                              for name, stage in stats.items() if name != "total"))
+
+        return stats
+
+    
+
+    def _store_chunks(self, text: str, chunks: List[Document], metadata: Dict[str, Any]):
+
+        if isinstance(self.documents, ChunkStore):
+
+            self.documents.add_source(text, chunks, metadata)
+
+        else:
+
+            for chunk in chunks:
+
+                chunk.metadata.update(metadata)
+
+            self.documents.extend(chunks)
+
+        
+
+    def _index_chunks(self, chunks: List[Document], ids: List[int]):
+
+        # A doc_id repeated in one batch leaves its first chunks deleted here
+
+        chunks, ids = self._live_pending(chunks, ids)
+
+        if not ids:
+
+            return
+
+        
+
+        # Encode chunks
+
+        embeddings = self.encoder.encode_documents(chunks)
+
+        
+
+        # Add to index
+
+        with self._index_lock:
+
+            self.index.add_documents(embeddings, np.asarray(ids, dtype=np.int64))
+
+            self._unindexed.difference_update(ids)
+
+        self.result_cache.clear()
+
+        
+
+    def _live_pending(self, chunks: List[Document], ids: List[int]) -> Tuple[List[Document], List[int]]:
+
+        """Drop pending chunks deleted before they reached the FAISS index"""
+
+        if all(chunk_id in self._unindexed for chunk_id in ids):
+
+            return chunks, ids
+
+        live = [i for i, chunk_id in enumerate(ids) if chunk_id in self._unindexed]
+
+        return [chunks[i] for i in live], [ids[i] for i in live]
+
+        
+
+    def _deduplicate(self, chunks: List[Tuple[int, Document]]):
+
+        """Split (chunk id, chunk) pairs into those to store and those to embed"""
+
+        stored, embed = [], []
+
+        for chunk_id, chunk in chunks:
+
+            signature = self.dedup.signature(chunk.text)
+
+            original = self.dedup.find(signature)
+
+            self._dedup_counts["chunks"] += 1
+
+            if original is None:
+
+                self.dedup.add(chunk_id, signature)
+
+                stored.append((chunk_id, chunk))
+
+                embed.append((chunk_id, chunk))
+
+                continue
+
+            
+
+            self._dedup_counts["duplicates"] += 1
+
+            self.duplicates[chunk_id] = original
+
+            if self.dedup_mode == "alias":
+
+                self._aliases.setdefault(original, []).append(chunk_id)
+
+                stored.append((chunk_id, chunk))
+
+        return stored, embed
+
+    
+
+    @property
+
+    def dedup_stats(self) -> Dict[str, int]:
+
+        """Chunks seen and skipped by dedup, with the encoder inputs and
+
+        (estimated) index bytes that saved"""
+
+        duplicates = self._dedup_counts["duplicates"]
+
+        return {
+
+            "chunks": self._dedup_counts["chunks"],
+
+            "duplicates": duplicates,
+
+            "encoder_calls_saved": duplicates,
+
+            "index_bytes_saved": duplicates * self.index.bytes_per_vector(),
+
+        }
+
+        
+
+    def upsert(self, doc_id: str, text: str, metadata: Optional[Dict[str, Any]] = None) -> int:
+
+        """Add or replace the document doc_id; returns its number of chunks"""
+
+        self._check_writable()
+
+        self.add_documents([text], doc_ids=[doc_id], metadatas=[metadata])
+
+        return len(self.doc_chunks[doc_id])
+
+    
+
+    def delete(self, doc_id: str) -> int:
+
+        """Remove the document doc_id; returns how many chunks it had
+
+        
+
+        Its vectors leave the FAISS index right away where the index type
+
+        allows it, and its chunks are tombstoned in the document store until
+
+        compact(). Unknown ids are ignored. With dedup="alias" a vector stays
+
+        while a live alias in another document still relies on it.
+
+        """
+
+        self._check_writable()
+
+        ids = self.doc_chunks.pop(doc_id, None)
+
+        if not ids:
+
+            return 0
+
+        self.deleted.update(ids)
+
+        
+
+        # The document's own vectors, and those kept only for aliases it had
+
+        candidates = [chunk_id for chunk_id in ids if chunk_id not in self.duplicates]
+
+        candidates += [self.duplicates[chunk_id] for chunk_id in ids
+
+                       if self.duplicates.get(chunk_id) in self._aliases]
+
+        release = [chunk_id for chunk_id in dict.fromkeys(candidates) if not self._serves(chunk_id)]
+
+        for chunk_id in release:
+
+            self._aliases.pop(chunk_id, None)
+
+        for chunk_id in ids:
+
+            self.duplicates.pop(chunk_id, None)
+
+        if self.dedup is not None:
+
+            self.dedup.remove(release)
+
+            
+
+        # Chunks still waiting to be encoded are simply never indexed
+
+        indexed = [chunk_id for chunk_id in release if chunk_id not in self._unindexed]
+
+        self._unindexed.difference_update(release)
+
+        self._stale += len(indexed) - self.index.remove_ids(indexed)
+
+        self.result_cache.clear()
+
+        if self.lexical is not None:
+
+            self.lexical.remove(ids)
+
+        return len(ids)
+
+    
+
+    def compact(self) -> int:
+
+        """Drop tombstoned chunks from the document store; returns how many
+
+        
+
+        Chunk ids, and therefore the FAISS index, are left untouched: an id
+
+        with no remaining row is simply skipped at search time.
+
+        """
+
+        self._check_writable()
+
+        if not self.deleted:
+
+            return 0
+
+        
+
+        rows = [row for row, chunk_id in enumerate(self.chunk_ids) if chunk_id not in self.deleted]
+
+        if isinstance(self.documents, ChunkStore):
+
+            self.documents = self.documents.select(rows)
+
+        else:
+
+            self.documents = [self.documents[row] for row in rows]
+
+        self.chunk_ids = array("q", (self.chunk_ids[row] for row in rows))
+
+        if self.lexical is not None:
+
+            self.lexical.compact()
+
+        self.filters.compact(self.deleted)
+
+        
+
+        removed = len(self.deleted)
+
+        self.deleted.clear()
+
+        self.result_cache.clear()
+
+        return removed
+
+    
+
+    def _serves(self, chunk_id: int) -> bool:
+
+        """Whether the vector of chunk_id still leads to a live chunk"""
+
+        return any(self._row(candidate) is not None
+
+                   for candidate in itertools.chain((chunk_id,), self._aliases.get(chunk_id, ())))
+
+    
+
+    def _resolve(self, chunk_id: int, id_mask: Optional[np.ndarray] = None) -> Optional[int]:
+
+        """Row for a vector hit: its own chunk, else a live alias of it"""
+
+        for candidate in itertools.chain((chunk_id,), self._aliases.get(chunk_id, ())):
+
+            if id_mask is not None and not id_mask[candidate]:
+
+                continue
+
+            row = self._row(candidate)
+
+            if row is not None:
+
+                return row
+
+        return None
+
+    
+
+    def _row(self, chunk_id: int) -> Optional[int]:
+
+        """Row of the live chunk with this id, or None if it was deleted"""
+
+        if chunk_id < 0 or chunk_id in self.deleted:
+
+            return None
+
+        row = bisect_left(self.chunk_ids, chunk_id)
+
+        if row < len(self.chunk_ids) and self.chunk_ids[row] == chunk_id:
+
+            return row
+
+        return None
+
+        
+
+    @contextmanager
+
+    def bulk_ingest(self):
+
+        """Defer index building across every add_documents call in the block
+
+        
+
+            with rag.bulk_ingest():
+
+                for batch in corpus:
+
+                    rag.add_documents(batch)
+
+        
+
+        Embeddings are buffered, trained index types are trained once on a
+
+        sample of the whole ingest, and FAISS receives large blocks on exit.
+
+        """
+
+        self.index.defer()
+
+        try:
+
+            yield self
+
+        finally:
+
+            self.index.defer(False)
+
+    
+
+    def search(self, query: str, k: int = 5, return_scores: bool = False,
+
+               min_score: Optional[float] = None, mode: Optional[str] = None,
+
+               where: Optional[Dict[str, Any]] = None) -> list:
+
+        """Search for relevant documents
+
+        
+
+        mode: "dense", "lexical" or "hybrid" (the default with lexical=True).
+
+        min_score: cosine cutoff, dense mode with metric="ip" only.
+
+        where: metadata filter (see MetadataIndex).
+
+        """
+
+        return self.search_many([query], k, return_scores, min_score, mode, where)[0]
+
+    
+
+    async def asearch(self, query: str, k: int = 5, return_scores: bool = False,
+
+                      min_score: Optional[float] = None, mode: Optional[str] = None,
+
+                      where: Optional[Dict[str, Any]] = None) -> list:
+
+        """search() for asyncio callers
+
+        
+
+        Concurrent calls are coalesced (see SearchCoalescer) into batched
+
+        search_many calls on a worker thread, so many simultaneous queries
+
+        share one encoder batch and one FAISS search.
+
+        """
+
+        if self.coalescer is None or self.coalescer.loop is not asyncio.get_running_loop():
+
+            self.coalescer = SearchCoalescer(self, self.COALESCE_WAIT, self.COALESCE_BATCH)
+
+        return await self.coalescer.submit(query, k=k, return_scores=return_scores,
+
+                                           min_score=min_score, mode=mode, where=where)
+
+    
+
+    def search_many(self, queries: List[str], k: int = 5, return_scores: bool = False,
+
+                    min_score: Optional[float] = None, mode: Optional[str] = None,
+
+                    where: Optional[Dict[str, Any]] = None) -> List[list]:
+
+        """Search many queries at once, returning one result list per query
+
+        
+
+        All queries are encoded in one encoder batch and looked up with one
+
+        FAISS search over the query matrix. Queries seen before, up to case
+
+        and whitespace, are answered from the caches.
+
+        """
+
+        if mode is None:
+
+            # min_score is a cosine threshold, which only dense scores are
+
+            mode = "hybrid" if self.lexical is not None and min_score is None else "dense"
+
+        if mode not in self.SEARCH_MODES:
+
+            raise ValueError(f"Unknown search mode {mode!r}; expected one of {self.SEARCH_MODES}")
+
+        if mode != "dense" and self.lexical is None:
+
+            raise ValueError(f"{mode} search needs a lexical index (RAGSystem(lexical=True))")
+
+        if min_score is not None and mode != "dense":
+
+            raise ValueError(f"min_score is a cosine similarity threshold and needs mode='dense', not {mode!r}")
+
+        if min_score is not None and self.index.metric != "ip":
+
+            raise ValueError("min_score needs an inner-product index (metric='ip')")
+
+        if not queries:
+
+            return []
+
+        
+
+        # Serve repeated queries from the result cache
+
+        options = (k, mode, min_score, json.dumps(where, sort_keys=True, default=repr) if where else None)
+
+        keys = [(self._normalize(query),) + options for query in queries]
+
+        results = [self.result_cache.get(key) for key in keys]
+
+        misses = [i for i, hits in enumerate(results) if hits is None]
+
+        if misses:
+
+            found = self._search_uncached([queries[i] for i in misses], k, min_score, mode, where)
+
+            for i, hits in zip(misses, found):
+
+                self.result_cache.put(keys[i], hits)
+
+                results[i] = hits
+
+                
+
+        return [list(hits) if return_scores else [doc for doc, _ in hits] for hits in results]
+
+    
+
+    def _search_uncached(self, queries: List[str], k: int, min_score: Optional[float], mode: str,
+
+                         where: Optional[Dict[str, Any]]) -> List[List[Tuple[Document, float]]]:
+
+        id_mask = self.filters.mask(where, self.next_chunk_id) if where else None
+
+        if id_mask is not None and not id_mask.any():
+
+            return [[] for _ in queries]
+
+        
+
+        depth = k if mode == "dense" else max(k, self.RRF_DEPTH)
+
+        if mode != "lexical":
+
+            dense = self._dense_search(queries, depth, min_score, id_mask)
+
+        
+
+        # Return matched documents
+
+        results = []
+
+        for i, query in enumerate(queries):
+
+            if mode == "dense":
+
+                hits = dense[i]
+
+            else:
+
+                scores, ids = self.lexical.search(query, depth, id_mask)
+
+                lexical = [(row, float(score)) for row, score in zip(map(self._row, ids.tolist()), scores)
+
+                           if row is not None]
+
+                hits = lexical if mode == "lexical" else self._fuse([dense[i], lexical])
+
+            results.append([(self.documents[row], score) for row, score in hits[:k]])
+
+        return results
+
+    
+
+    @staticmethod
+
+    def _normalize(query: str) -> str:
+
+        return " ".join(query.split()).lower()
+
+    
+
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+
+        """Query embeddings, encoding only those not in the query cache"""
+
+        keys = [self._normalize(query) for query in queries]
+
+        embeddings = [self.query_cache.get(key) for key in keys]
+
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+        if misses:
+
+            # Queries stay out of the on-disk chunk cache (and its commits)
+
+            encoded = self.encoder.encode_documents([Document(text=queries[i]) for i in misses],
+
+                                                    use_cache=False)
+
+            for i, embedding in zip(misses, encoded):
+
+                self.query_cache.put(keys[i], embedding)
+
+                embeddings[i] = embedding
+
+        return np.stack(embeddings)
+
+    
+
+    @property
+
+    def cache_stats(self) -> Dict[str, float]:
+
+        """Hit counters of the query-embedding and result caches"""
+
+        return {
+
+            "embedding_hits": self.query_cache.hits,
+
+            "embedding_misses": self.query_cache.misses,
+
+            "embedding_hit_rate": self.query_cache.hit_rate,
+
+            "result_hits": self.result_cache.hits,
+
+            "result_misses": self.result_cache.misses,
+
+            "result_hit_rate": self.result_cache.hit_rate,
+
+        }
+
+    
+
+    def _dense_search(self, queries: List[str], k: int, min_score: Optional[float],
+
+                      id_mask: Optional[np.ndarray] = None) -> List[List[Tuple[int, float]]]:
+
+        """Top k (row, score) pairs per query from the vector index"""
+
+        query_embeddings = self._encode_queries(queries)
+
+        
+
+        vector_mask = id_mask
+
+        if id_mask is not None and self._aliases:
+
+            # A vector matches when any chunk it stands for does
+
+            vector_mask = id_mask.copy()
+
+            for chunk_id, aliases in self._aliases.items():
+
+                if not vector_mask[chunk_id] and id_mask[aliases].any():
+
+                    vector_mask[chunk_id] = True
+
+        
+
+        # Search index, over-fetching a little to make up for deleted vectors
+
+        # the index could not drop
+
+        distances, indices = self.index.search_many(query_embeddings, k + min(self._stale, 10 * k),
+
+                                                    id_mask=vector_mask)
+
+        
+
+        # FAISS pads with -1 when it has fewer than k
+
+        results = []
+
+        for row_scores, row_ids in zip(distances, indices):
+
+            hits = []
+
+            for chunk_id, score in zip(row_ids, row_scores):
+
+                if min_score is not None and score < min_score:
+
+                    continue
+
+                if chunk_id < 0:
+
+                    continue
+
+                row = self._resolve(int(chunk_id), id_mask)
+
+                if row is not None:
+
+                    hits.append((row, float(score)))
+
+            results.append(hits[:k])
+
+        return results
+
+    
+
+    def _fuse(self, rankings: List[List[Tuple[int, float]]]) -> List[Tuple[int, float]]:
+
+        """Reciprocal rank fusion of (row, score) rankings"""
+
+        fused: Dict[int, float] = {}
+
+        for ranking in rankings:
+
+            for rank, (row, _) in enumerate(ranking, 1):
+
+                fused[row] = fused.get(row, 0.0) + 1.0 / (self.RRF_K + rank)
+
+        return sorted(fused.items(), key=lambda hit: hit[1], reverse=True)
+
+    
+
+    def save(self, directory: str):
+
+        """Save the entire RAG system
+
+        
+
+        Files go to a new gen-N subdirectory, and CURRENT, naming it, is
+
+        replaced last: an interrupted save leaves the previous copy intact.
+
+        """
+
+        os.makedirs(directory, exist_ok=True)
+
+        generations = [name for name in os.listdir(directory) if re.fullmatch(r"gen-\d+", name)]
+
+        generation = f"gen-{max((int(name[4:]) for name in generations), default=0) + 1}"
+
+        current = directory
+
+        directory = os.path.join(current, generation)
+
+        os.makedirs(directory)
+
+        
+
+        # Save FAISS index
+
+        self.index.save(os.path.join(directory, "index.faiss"))
+
+        
+
+        # Save documents
+
+        MappedDocumentStore.write(self.documents, os.path.join(directory, "documents.jsonl"),
+
+                                  os.path.join(directory, "documents.idx"))
+
+        chunks_path = os.path.join(directory, "chunks.npz")
+
+        sources_path = os.path.join(directory, "sources.jsonl")
+
+        if isinstance(self.documents, ChunkStore):
+
+            self.documents.save(chunks_path, sources_path)
+
+        
+
+        # Save chunk ids, document ids and tombstones
+
+        with atomic_write(os.path.join(directory, "chunk_ids.bin")) as f:
+
+            np.asarray(self.chunk_ids, dtype="<i8").tofile(f)
+
+        state = {
+
+            "next_chunk_id": self.next_chunk_id,
+
+            "doc_chunks": {doc_id: [ids.start, ids.stop] for doc_id, ids in self.doc_chunks.items()},
+
+            "deleted": sorted(self.deleted),
+
+            "stale": self._stale,
+
+            "duplicates": list(self.duplicates.items()),
+
+        }
+
+        with atomic_write(os.path.join(directory, "state.json"), "w") as f:
+
+            json.dump(state, f)
+
+        
+
+        # Save the lexical and metadata indexes
+
+        if self.lexical is not None:
+
+            self.lexical.save(os.path.join(directory, "lexical.npz"))
+
+        self.filters.save(os.path.join(directory, "filters.npz"))
+
+        if self.dedup is not None:
+
+            self.dedup.save(os.path.join(directory, "dedup.npz"))
+
+        
+
+        # Commit: readers switch to the new generation only once it is complete
+
+        with atomic_write(os.path.join(current, "CURRENT"), "w") as f:
+
+            f.write(generation)
+
+        for name in generations:
+
+            shutil.rmtree(os.path.join(current, name), ignore_errors=True)
+
+    
+
+    @staticmethod
+
+    def _generation(directory: str) -> str:
+
+        """The directory holding the last complete save under directory"""
+
+        current_path = os.path.join(directory, "CURRENT")
+
+        if not os.path.exists(current_path):
+
+            # Saved before generations: the files sit in directory itself
+
+            return directory
+
+        with open(current_path, "r") as f:
+
+            return os.path.join(directory, f.read().strip())
+
+    
+
+    def load(self, directory: str, mmap: bool = False):
+
+        """Load the entire RAG system
+
+        
+
+        mmap=True memory-maps index.faiss and the document store, so cold
+
+        start does not read the whole store and documents are decoded lazily
+
+        by id. The loaded system is then read-only: methods that would
+
+        change it raise ValueError. Directories saved in the older single
+
+        documents.json format still load.
+
+        """
+
+        self.read_only = mmap
+
+        directory = self._generation(directory)
+
+        # Load FAISS index
+
+        self.index.load(os.path.join(directory, "index.faiss"), mmap=mmap)
+
+        self.result_cache.clear()
+
+        
+
+        self._load_documents(directory, mmap)
+
+        self._load_state(directory)
+
+        self._load_dedup(directory)
+
+        
+
+        if self.lexical is not None:
+
+            lexical_path = os.path.join(directory, "lexical.npz")
+
+            self.lexical = BM25Index()
+
+            if os.path.exists(lexical_path):
+
+                self.lexical.load(lexical_path)
+
+            else:
+
+                logger.info("No lexical index in %s; building it from the documents", directory)
+
+                live = [(chunk_id, doc.text) for chunk_id, doc in zip(self.chunk_ids, self.documents)
+
+                        if chunk_id not in self.deleted]
+
+                self.lexical.add((chunk_id for chunk_id, _ in live), (text for _, text in live))
+
+        
+
+        filters_path = os.path.join(directory, "filters.npz")
+
+        self.filters = MetadataIndex()
+
+        if os.path.exists(filters_path):
+
+            self.filters.load(filters_path)
+
+            if "doc_id" not in self.filters.postings and self.doc_chunks:
+
+                # Saved before doc_id was filterable
+
+                stored = set(self.chunk_ids)
+
+                for doc_id, ids in self.doc_chunks.items():
+
+                    self.filters.add([chunk_id for chunk_id in ids if chunk_id in stored], {"doc_id": doc_id})
+
+        else:
+
+            logger.info("No metadata index in %s; building it from the documents", directory)
+
+            for chunk_id, doc in zip(self.chunk_ids, self.documents):
+
+                if chunk_id not in self.deleted:
+
+                    self.filters.add([chunk_id], {field: value for field, value in doc.metadata.items()
+
+                                                  if field not in ("start", "end")})
+
+    
+
+    def _load_dedup(self, directory: str):
+
+        self._aliases = {}
+
+        if self.dedup_mode == "alias":
+
+            for chunk_id, original in self.duplicates.items():
+
+                self._aliases.setdefault(original, []).append(chunk_id)
+
+        if self.dedup is not None:
+
+            self.dedup = NearDuplicateFilter()
+
+            dedup_path = os.path.join(directory, "dedup.npz")
+
+            if os.path.exists(dedup_path):
+
+                self.dedup.load(dedup_path)
+
+    
+
+    def _load_state(self, directory: str):
+
+        state_path = os.path.join(directory, "state.json")
+
+        if not os.path.exists(state_path):
+
+            # Saved before chunk ids existed: ids are row positions
+
+            self.chunk_ids = array("q", range(len(self.documents)))
+
+            self.next_chunk_id = len(self.documents)
+
+            self.doc_chunks = {}
+
+            self.deleted = set()
+
+            self._stale = 0
+
+            self._unindexed = set()
+
+            self.duplicates = {}
+
+            return
+
+        
+
+        with open(state_path, "r") as f:
+
+            state = json.load(f)
+
+        self.chunk_ids = array("q", np.fromfile(os.path.join(directory, "chunk_ids.bin"), dtype="<i8").tobytes())
+
+        self.next_chunk_id = state["next_chunk_id"]
+
+        self.doc_chunks = {doc_id: range(start, stop) for doc_id, (start, stop) in state["doc_chunks"].items()}
+
+        self.deleted = set(state["deleted"])
+
+        self._stale = state["stale"]
+
+        self._unindexed = set()
+
+        self.duplicates = dict(state.get("duplicates", []))
+
+    
+
+    def _load_documents(self, directory: str, mmap: bool):
+
+        data_path = os.path.join(directory, "documents.jsonl")
+
+        if not os.path.exists(data_path):
+
+            # Load documents
+
+            with open(os.path.join(directory, "documents.json"), "r") as f:
+
+                documents_data = json.load(f)
+
+                self.documents = [
+
+                    Document(text=doc["text"], metadata=doc["metadata"])
+
+                    for doc in documents_data
+
+                ]
+
+            return
+
+        
+
+        chunks_path = os.path.join(directory, "chunks.npz")
+
+        sources_path = os.path.join(directory, "sources.jsonl")
+
+        if self._compact and not mmap:
+
+            if os.path.exists(chunks_path) and os.path.exists(sources_path):
+
+                self.documents = ChunkStore()
+
+                self.documents.load(chunks_path, sources_path)
+
+                return
+
+            logger.info("No chunk store in %s; loading the documents as a list", directory)
+
+        
 
-        with open(os.path.join(directory, "documents.json"), "r") as f:
+        store = MappedDocumentStore(data_path, os.path.join(directory, "documents.idx"))
 
-            documents_data = json.load(f)
+        if mmap:
 
-            self.documents = [
+            self.documents = store
 
-                Document(text=doc["text"], metadata=doc["metadata"])
+        else:
 
-                for doc in documents_data
+            self.documents = list(store)
 
-            ]
+            store.close()
 
 
 
@@ -0,0 +1,397 @@
+"""Benchmarks for the HybridChunker RAG pipeline.
+
+Usage:
+    python bench_hybrid_chunker.py chunking --size-mb 50
+    python bench_hybrid_chunker.py segmentation --segmenters sentencizer regex
+    python bench_hybrid_chunker.py encoder --backends onnx int8
+    python bench_hybrid_chunker.py compression --configs L2/pca:192 IVFPQ/opq:256
+    python bench_hybrid_chunker.py async --clients 64
+    python bench_hybrid_chunker.py ingest --workers 8
+    python bench_hybrid_chunker.py invariants --examples 2000
+    python bench_hybrid_chunker.py adversarial --size-mb 10
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+from typing import List, Tuple
+
+import faiss
+import numpy as np
+
+from HybridChunker import Document, FAISSIndex, HybridChunker, HybridEncoder, RAGSystem
+
+WORDS = [
+    "account", "policy", "section", "client", "advisor", "portfolio", "risk",
+    "the", "of", "and", "must", "review", "annual", "statement", "transfer",
+    "approval", "compliance", "record", "within", "days", "request", "fee",
+    "trade", "settlement", "exception", "holder", "beneficiary", "document",
+]
+
+
+def synthetic_corpus(size_bytes: int, seed: int = 0) -> Tuple[str, List[int]]:
+    """Build a text of roughly size_bytes characters and its sentence boundaries.
+
+    The boundaries are known by construction, so the benchmark measures the
+    chunk walk itself rather than sentence segmentation.
+    """
+    rng = random.Random(seed)
+    parts = []
+    boundaries = [0]
+    length = 0
+    while length < size_bytes:
+        sentence = " ".join(rng.choices(WORDS, k=rng.randint(4, 24))).capitalize() + "."
+        parts.append(sentence)
+        length += len(sentence)
+        boundaries.append(length)
+        parts.append(" ")
+        length += 1
+    return "".join(parts), boundaries
+
+
+def bench_chunking(args):
+    text, boundaries = synthetic_corpus(int(args.size_mb * 1024 * 1024))
+    chunker = HybridChunker(segmenter="regex")
+
+    start = time.perf_counter()
+    spans = chunker._chunk_spans(text, boundaries, args.max_chunk_size, args.overlap)
+    elapsed = time.perf_counter() - start
+
+    rate = len(spans) / elapsed
+    print(f"chunking: {len(text) / 1e6:.1f} MB, {len(boundaries) - 1} sentences, "
+          f"{len(spans)} chunks in {elapsed:.2f}s ({rate:,.0f} chunks/sec)")
+    if args.min_rate and rate < args.min_rate:
+        print(f"FAIL: {rate:,.0f} chunks/sec is below --min-rate {args.min_rate:,.0f}")
+        return 1
+    return 0
+
+
+def bench_segmentation(args):
+    # Stay under spaCy's default max_length so the full pipeline can run
+    text, _ = synthetic_corpus(int(args.size_mb * 1024 * 1024))
+    for segmenter in args.segmenters:
+        chunker = HybridChunker(segmenter=segmenter)
+        start = time.perf_counter()
+        boundaries = chunker._get_semantic_boundaries(text)
+        elapsed = time.perf_counter() - start
+        print(f"segmentation[{segmenter}]: {len(boundaries) - 1} boundaries in {elapsed:.2f}s "
+              f"({len(text) / 1e6 / elapsed:.2f} MB/sec)")
+    return 0
+
+
+def synthetic_sentences(count: int, seed: int = 0) -> List[Document]:
+    rng = random.Random(seed)
+    return [Document(text=" ".join(rng.choices(WORDS, k=rng.randint(6, 40))).capitalize() + ".")
+            for _ in range(count)]
+
+
+def recall_at_k(expected: np.ndarray, found: np.ndarray) -> float:
+    """Fraction of the reference top-k neighbours that appear in found"""
+    hits = sum(len(set(e) & set(f)) for e, f in zip(expected, found))
+    return hits / expected.size
+
+
+def timed_encode(encoder: HybridEncoder, documents: List[Document]) -> Tuple[np.ndarray, float]:
+    start = time.perf_counter()
+    embeddings = encoder.encode_documents(documents)
+    return embeddings, time.perf_counter() - start
+
+
+def bench_encoder(args):
+    corpus = synthetic_sentences(args.corpus, seed=1)
+    queries = synthetic_sentences(args.queries, seed=2)
+
+    reference = HybridEncoder(args.model, device="cpu")
+    corpus_ref, elapsed = timed_encode(reference, corpus)
+    query_ref = reference.encode_documents(queries)
+    print(f"encoder[torch]: {len(corpus) / elapsed:,.1f} texts/sec")
+
+    index = FAISSIndex(corpus_ref.shape[1])
+    index.add_documents(corpus_ref)
+    expected = np.stack([index.search(q, args.k)[1] for q in query_ref])
+
+    for backend in args.backends:
+        encoder = HybridEncoder(args.model, device="cpu", backend=backend)
+        corpus_emb, elapsed = timed_encode(encoder, corpus)
+        query_emb = encoder.encode_documents(queries)
+
+        # Same index type and dimension as the PyTorch path: the vectors are drop-in
+        backend_index = FAISSIndex(corpus_emb.shape[1])
+        backend_index.add_documents(corpus_emb)
+        found = np.stack([backend_index.search(q, args.k)[1] for q in query_emb])
+
+        cosine = np.sum(corpus_emb * corpus_ref, axis=1) / (
+            np.linalg.norm(corpus_emb, axis=1) * np.linalg.norm(corpus_ref, axis=1))
+        print(f"encoder[{backend}]: {len(corpus) / elapsed:,.1f} texts/sec, "
+              f"recall@{args.k} vs torch {recall_at_k(expected, found):.3f}, "
+              f"mean cosine to torch {cosine.mean():.4f}")
+    return 0
+
+
+def parse_config(config: str) -> dict:
+    """"IVFPQ/opq:256" -> FAISSIndex options"""
+    index_type, _, reduction = config.partition("/")
+    options = {"index_type": index_type}
+    if reduction:
+        transform, _, dim = reduction.partition(":")
+        options.update(transform=transform, reduce_dim=int(dim))
+    return options
+
+
+def bench_compression(args):
+    corpus = synthetic_sentences(args.corpus, seed=1)
+    queries = synthetic_sentences(args.queries, seed=2)
+    encoder = HybridEncoder(args.model, device="cpu")
+    corpus_emb = encoder.encode_documents(corpus)
+    query_emb = encoder.encode_documents(queries)
+
+    reference = FAISSIndex(corpus_emb.shape[1])
+    reference.add_documents(corpus_emb)
+    expected = reference.search_many(query_emb, args.k)[1]
+    full_size = len(faiss.serialize_index(reference.index))
+    print(f"compression[L2]: {full_size / len(corpus):,.0f} bytes/vector, recall@{args.k} 1.000")
+
+    for config in args.configs:
+        index = FAISSIndex(corpus_emb.shape[1], **parse_config(config))
+        index.add_documents(corpus_emb)
+        found = index.search_many(query_emb, args.k, nprobe=args.nprobe)[1]
+        size = len(faiss.serialize_index(index.index))
+        print(f"compression[{config}]: {size / len(corpus):,.0f} bytes/vector "
+              f"({full_size / size:.1f}x smaller), recall@{args.k} {recall_at_k(expected, found):.3f}")
+    return 0
+
+
+def bench_async(args):
+    # Caching off, so every query really reaches the encoder and FAISS
+    rag = RAGSystem(HybridChunker(segmenter="regex"), HybridEncoder(args.model, device="cpu"),
+                    cache_size=0)
+    rag.add_documents(doc.text for doc in synthetic_sentences(args.corpus, seed=1))
+    queries = [doc.text for doc in synthetic_sentences(args.queries, seed=2)]
+
+    start = time.perf_counter()
+    for query in queries:
+        rag.search(query, k=args.k)
+    sequential = time.perf_counter() - start
+    print(f"async[search]: {len(queries) / sequential:,.1f} queries/sec, "
+          f"{sequential / len(queries) * 1000:.1f} ms/query")
+
+    async def single():
+        start = time.perf_counter()
+        for query in queries[:args.clients]:
+            await rag.asearch(query, k=args.k)
+        return (time.perf_counter() - start) / min(args.clients, len(queries))
+
+    async def concurrent():
+        pending = asyncio.Queue()
+        for query in queries:
+            pending.put_nowait(query)
+
+        async def client():
+            while not pending.empty():
+                await rag.asearch(pending.get_nowait(), k=args.k)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(args.clients)))
+        return time.perf_counter() - start
+
+    latency = asyncio.run(single())
+    print(f"async[asearch, 1 client]: {latency * 1000:.1f} ms/query")
+    elapsed = asyncio.run(concurrent())
+    stats = rag.coalescer.stats
+    print(f"async[asearch, {args.clients} clients]: {len(queries) / elapsed:,.1f} queries/sec "
+          f"({sequential / elapsed:.1f}x), {stats['queries'] / stats['batches']:.1f} queries/batch")
+    return 0
+
+
+def bench_ingest(args):
+    texts = [synthetic_corpus(args.text_bytes, seed=i)[0] for i in range(args.texts)]
+
+    def system():
+        return RAGSystem(HybridChunker(segmenter=args.segmenter), HybridEncoder(args.model, device="cpu"))
+
+    start = time.perf_counter()
+    system().add_documents(texts)
+    sequential = time.perf_counter() - start
+    print(f"ingest[add_documents]: {len(texts) / sequential:,.1f} texts/sec")
+
+    stats = system().ingest(texts, workers=args.workers)
+    total = stats.pop("total")
+    print(f"ingest[pipelined]: {total['per_second']:,.1f} texts/sec ({sequential / total['seconds']:.1f}x)")
+    for name, stage in stats.items():
+        print(f"  {name}: {stage['items']:,} items, {stage['per_second']:,.1f}/sec busy, "
+              f"{stage['seconds']:.1f}s busy, {stage['waiting']:.1f}s waiting")
+    return 0
+
+
+def span_violation(text: str, spans: List[Tuple[int, int]], max_chunk_size: int,
+                   overlap: int) -> str:
+    """Describe the first chunk walk invariant the spans break, or return an empty string"""
+    text_end = len(text.rstrip())
+    min_stride = max(1, (max_chunk_size - overlap) // 2)
+    if not spans:
+        return "" if text_end == 0 else "no chunks for non-blank text"
+    if spans[0][0] != 0:
+        return f"first chunk starts at {spans[0][0]}"
+    if not text_end <= spans[-1][1] <= len(text):
+        return f"last chunk ends at {spans[-1][1]}, text ends at {text_end}"
+    for i, (start, end) in enumerate(spans):
+        if not 0 < end - start <= max_chunk_size:
+            return f"chunk {i} {(start, end)} is not 1..{max_chunk_size} long"
+        if i and start - spans[i - 1][0] < min_stride:
+            return f"chunk {i} starts {start - spans[i - 1][0]} after the previous one (< {min_stride})"
+        if i and start > spans[i - 1][1]:
+            return f"gap between chunk {i - 1} {spans[i - 1]} and chunk {i} {(start, end)}"
+        if i and spans[i - 1][1] - start > overlap:
+            return f"chunks {i - 1} and {i} overlap by {spans[i - 1][1] - start} (> {overlap})"
+    return ""
+
+
+def random_case(rng: random.Random, chunker: HybridChunker) -> Tuple[str, List[int], int, int]:
+    """Draw a text, its boundaries and chunk settings, weighted toward the degenerate shapes"""
+    shape = rng.choice(["words", "short", "unpunctuated", "huge", "whitespace"])
+    if shape == "words":
+        text = synthetic_corpus(rng.randint(0, 5000), seed=rng.getrandbits(32))[0]
+    elif shape == "short":
+        text = "A. " * rng.randint(0, 2000)
+    elif shape == "unpunctuated":
+        text = " ".join(rng.choices(WORDS, k=rng.randint(0, 800)))
+    elif shape == "huge":
+        text = "x" * rng.randint(1, 5000)
+    else:
+        text = rng.choice(WORDS) + " " * rng.randint(0, 500) + "\n" * rng.randint(0, 50)
+    if rng.random() < 0.5:
+        boundaries = chunker._get_semantic_boundaries(text)
+    else:
+        boundaries = sorted({0, *rng.sample(range(1, len(text) + 1), min(len(text), rng.randint(0, 200)))})
+    max_chunk_size = rng.choice([1, 2, 3, 8, 64, 256, 512, rng.randint(1, 2048)])
+    overlap = rng.choice([0, max_chunk_size - 1, rng.randrange(max_chunk_size)])
+    return text, boundaries, max_chunk_size, overlap
+
+
+def bench_invariants(args):
+    chunker = HybridChunker(segmenter="regex")
+
+    def check(rng):
+        text, boundaries, max_chunk_size, overlap = random_case(rng, chunker)
+        spans = chunker._chunk_spans(text, boundaries, max_chunk_size, overlap)
+        violation = span_violation(text, spans, max_chunk_size, overlap)
+        assert not violation, (f"{violation} (len(text)={len(text)}, {len(boundaries)} boundaries, "
+                               f"max_chunk_size={max_chunk_size}, overlap={overlap})")
+
+    try:
+        from hypothesis import given, settings, strategies as st
+    except ImportError:
+        # Without hypothesis, fall back to seeded fuzzing over the same cases
+        for seed in range(args.examples):
+            try:
+                check(random.Random(seed))
+            except AssertionError as error:
+                print(f"FAIL (seed {seed}): {error}")
+                return 1
+        print(f"invariants: {args.examples} random cases passed")
+        return 0
+
+    property_test = settings(max_examples=args.examples, deadline=None)(given(st.randoms())(check))
+    try:
+        property_test()
+    except AssertionError as error:
+        print(f"FAIL: {error}")
+        return 1
+    print(f"invariants: {args.examples} hypothesis examples passed")
+    return 0
+
+
+def bench_adversarial(args):
+    size = int(args.size_mb * 1024 * 1024)
+    chunker = HybridChunker(segmenter="regex")
+    corpora = {
+        "short sentences": "A. " * (size // 3),
+        "no punctuation": " ".join(random.Random(0).choices(WORDS, k=size // 8)),
+        "one huge sentence": "x" * size,
+    }
+    failed = False
+    for name, text in corpora.items():
+        boundaries = chunker._get_semantic_boundaries(text)
+        start = time.perf_counter()
+        spans = chunker._chunk_spans(text, boundaries, args.max_chunk_size, args.overlap)
+        elapsed = time.perf_counter() - start
+        violation = span_violation(text, spans, args.max_chunk_size, args.overlap)
+        print(f"adversarial[{name}]: {len(boundaries) - 1} boundaries, {len(spans)} chunks "
+              f"in {elapsed:.2f}s ({len(spans) / elapsed:,.0f} chunks/sec)"
+              + (f" FAIL: {violation}" if violation else ""))
+        failed = failed or bool(violation)
+    return 1 if failed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    chunking = commands.add_parser("chunking", help="chunk walk over a synthetic corpus")
+    chunking.add_argument("--size-mb", type=float, default=50)
+    chunking.add_argument("--max-chunk-size", type=int, default=512)
+    chunking.add_argument("--overlap", type=int, default=50)
+    chunking.add_argument("--min-rate", type=float, default=0,
+                          help="exit non-zero below this many chunks/sec")
+    chunking.set_defaults(func=bench_chunking)
+
+    segmentation = commands.add_parser("segmentation", help="sentence boundaries per segmenter")
+    segmentation.add_argument("--size-mb", type=float, default=0.9)
+    segmentation.add_argument("--segmenters", nargs="+", default=list(HybridChunker.SEGMENTERS),
+                              choices=HybridChunker.SEGMENTERS)
+    segmentation.set_defaults(func=bench_segmentation)
+
+    encoder = commands.add_parser("encoder", help="encoder backends: throughput and recall")
+    encoder.add_argument("--model", default="sentence-transformers/all-mpnet-base-v2")
+    encoder.add_argument("--backends", nargs="+", default=["onnx", "int8"],
+                         choices=[b for b in HybridEncoder.BACKENDS if b != "torch"])
+    encoder.add_argument("--corpus", type=int, default=2000)
+    encoder.add_argument("--queries", type=int, default=200)
+    encoder.add_argument("-k", type=int, default=10)
+    encoder.set_defaults(func=bench_encoder)
+
+    compression = commands.add_parser("compression", help="index size vs recall per reduction")
+    compression.add_argument("--model", default="sentence-transformers/all-mpnet-base-v2")
+    compression.add_argument("--configs", nargs="+",
+                             default=["L2/pca:192", "L2/pca:96", "L2/opq:192", "IVFPQ", "IVFPQ/opq:256"],
+                             help="INDEX_TYPE[/pca:DIM|/opq:DIM]")
+    compression.add_argument("--corpus", type=int, default=20000)
+    compression.add_argument("--queries", type=int, default=200)
+    compression.add_argument("--nprobe", type=int, default=None)
+    compression.add_argument("-k", type=int, default=10)
+    compression.set_defaults(func=bench_compression)
+
+    asynchronous = commands.add_parser("async", help="coalesced asearch vs sequential search")
+    asynchronous.add_argument("--model", default="sentence-transformers/all-mpnet-base-v2")
+    asynchronous.add_argument("--corpus", type=int, default=20000)
+    asynchronous.add_argument("--queries", type=int, default=2000)
+    asynchronous.add_argument("--clients", type=int, default=64)
+    asynchronous.add_argument("-k", type=int, default=5)
+    asynchronous.set_defaults(func=bench_async)
+
+    ingest = commands.add_parser("ingest", help="pipelined ingest vs add_documents, per stage")
+    ingest.add_argument("--model", default="sentence-transformers/all-mpnet-base-v2")
+    ingest.add_argument("--segmenter", default="sentencizer", choices=HybridChunker.SEGMENTERS)
+    ingest.add_argument("--texts", type=int, default=2000)
+    ingest.add_argument("--text-bytes", type=int, default=8000)
+    ingest.add_argument("--workers", type=int, default=None)
+    ingest.set_defaults(func=bench_ingest)
+
+    invariants = commands.add_parser("invariants", help="property checks over the chunk walk")
+    invariants.add_argument("--examples", type=int, default=2000)
+    invariants.set_defaults(func=bench_invariants)
+
+    adversarial = commands.add_parser("adversarial", help="chunk walk over degenerate inputs")
+    adversarial.add_argument("--size-mb", type=float, default=10)
+    adversarial.add_argument("--max-chunk-size", type=int, default=512)
+    adversarial.add_argument("--overlap", type=int, default=50)
+    adversarial.set_defaults(func=bench_adversarial)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()